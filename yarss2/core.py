@@ -11,7 +11,7 @@ from deluge.core.rpcserver import export
 from deluge.plugins.pluginbase import CorePluginBase
 
 import yarss2.util.common
-from yarss2.rssfeed_scheduler import RSSFeedScheduler
+from yarss2.rssfeed_scheduler import RUN_LANE_INTERACTIVE, RSSFeedScheduler
 from yarss2.torrent_handling import TorrentHandler
 from yarss2.util import logging
 from yarss2.util.http import get_matching_cookies_dict
@@ -55,7 +55,25 @@ class Core(CorePluginBase):
 
     @export
     def initiate_rssfeed_update(self, rssfeed_key, subscription_key=None):
-        return self.rssfeed_scheduler.queue_rssfeed_update(rssfeed_key, subscription_key=subscription_key)
+        return self.rssfeed_scheduler.queue_rssfeed_update(rssfeed_key, subscription_key=subscription_key,
+                                                           lane=RUN_LANE_INTERACTIVE)
+
+    @export
+    def get_run_queue_stats(self):
+        """Returns the number of queued jobs and the queue wait times of each lane in the run queue,
+        the stats of the download and add stages, and the number of overload events"""
+        return self.rssfeed_scheduler.get_run_queue_stats()
+
+    @export
+    def get_rssfeed_poll_stats(self):
+        """Returns the stats on new items per fetch of each RSS Feed, with the current update interval"""
+        return self.rssfeed_scheduler.get_poll_stats()
+
+    @export
+    def get_rssfeed_metrics(self, rssfeed_key=None):
+        """Returns the metrics of the last updates of each RSS Feed (or only of the RSS Feed
+        with rssfeed_key), with a summary of the durations, bytes, matches and errors."""
+        return self.rssfeed_scheduler.metrics.get_metrics(rssfeed_key)
 
     @export
     def get_config(self):
@@ -67,6 +85,7 @@ class Core(CorePluginBase):
         conf = {"general": conf}
         try:
             self.yarss_config.set_config(conf)
+            self.rssfeed_scheduler.update_run_queue_limits()
         except ValueError as v:
             self.log.error("Failed to save general configurations:" + str(v))
 
@@ -90,8 +109,12 @@ class Core(CorePluginBase):
                 self.log.info("Deleting Subscription '%s'" %
                               self.yarss_config.get_config()["subscriptions"][dict_key]["name"])
         try:
-            return self.yarss_config.generic_save_config("subscriptions", dict_key=dict_key,
-                                                         data_dict=subscription_data, delete=delete)
+            config = self.yarss_config.generic_save_config("subscriptions", dict_key=dict_key,
+                                                           data_dict=subscription_data, delete=delete)
+            # The changed subscription must be matched against the whole feed on the next update
+            if subscription_data is not None:
+                self.rssfeed_scheduler.rssfeedhandler.clear_http_validators(subscription_data["rssfeed_key"])
+            return config
         except ValueError as v:
             self.log.error("Failed to save subscription:" + str(v))
         return None
@@ -113,6 +136,7 @@ class Core(CorePluginBase):
                                                            data_dict=rssfeed_data, delete=delete)
             if delete is True:
                 self.rssfeed_scheduler.delete_timer(dict_key)
+                self.rssfeed_scheduler.rssfeedhandler.clear_http_validators(dict_key)
             # Successfully saved rssfeed, check if timer was changed
             elif config:
                 if self.rssfeed_scheduler.set_timer(rssfeed_data["key"], rssfeed_data["update_interval"],
@@ -180,6 +204,5 @@ class Core(CorePluginBase):
 
     @export
     def get_rssfeed_parsed(self, rssfeed_data, site_cookies_dict=None, user_agent=None):
-        return self.rssfeed_scheduler.rssfeedhandler.get_rssfeed_parsed(rssfeed_data,
-                                                                        site_cookies_dict=site_cookies_dict,
-                                                                        user_agent=user_agent)
+        return self.rssfeed_scheduler.queue_rssfeed_parsed(rssfeed_data, site_cookies_dict=site_cookies_dict,
+                                                           user_agent=user_agent)
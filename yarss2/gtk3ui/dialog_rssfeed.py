@@ -33,6 +33,7 @@ class DialogRSSFeed(object):
             "on_checkbox_ebey_ttl_query_tooltip": self.on_checkbox_ebey_ttl_query_tooltip,
             "on_checkbox_prefer_magnet_query_tooltip": self.on_checkbox_prefer_magnet_query_tooltip,
             "on_checkbox_run_on_startup_query_tooltip": self.on_checkbox_run_on_startup_query_tooltip,
+            "on_checkbox_adaptive_interval_query_tooltip": self.on_checkbox_adaptive_interval_query_tooltip,
         })
         self.populate_data_fields()
 
@@ -55,6 +56,7 @@ class DialogRSSFeed(object):
             self.glade.get_object("checkbutton_on_startup").set_active(self.rssfeed["update_on_startup"])
             self.glade.get_object("checkbox_obey_ttl").set_active(self.rssfeed["obey_ttl"])
             self.glade.get_object("checkbox_prefer_magnet").set_active(self.rssfeed["prefer_magnet"])
+            self.glade.get_object("checkbox_adaptive_interval").set_active(self.rssfeed["adaptive_interval"])
 
             cookies = http.get_matching_cookies_dict(self.gtkUI.cookies, self.rssfeed["site"])
             cookies_hdr = http.get_cookie_header(cookies)
@@ -73,6 +75,8 @@ class DialogRSSFeed(object):
                 self.glade.get_object("checkbox_obey_ttl").set_sensitive(False)
                 self.glade.get_object("checkbox_prefer_magnet").set_active(False)
                 self.glade.get_object("checkbox_prefer_magnet").set_sensitive(False)
+                self.glade.get_object("checkbox_adaptive_interval").set_active(False)
+                self.glade.get_object("checkbox_adaptive_interval").set_sensitive(False)
                 self.glade.get_object("button_save").set_sensitive(False)
 
     def get_data_fields(self, cookies=False):
@@ -86,6 +90,7 @@ class DialogRSSFeed(object):
         rssfeed_data["update_on_startup"] = self.glade.get_object("checkbutton_on_startup").get_active()
         rssfeed_data["obey_ttl"] = self.glade.get_object("checkbox_obey_ttl").get_active()
         rssfeed_data["prefer_magnet"] = self.glade.get_object("checkbox_prefer_magnet").get_active()
+        rssfeed_data["adaptive_interval"] = self.glade.get_object("checkbox_adaptive_interval").get_active()
         if cookies:
             rssfeed_data["cookies"] = self.glade.get_object("txt_cookies").get_text()
         return rssfeed_data
@@ -126,6 +131,11 @@ class DialogRSSFeed(object):
         return set_tooltip_markup(
             tooltip, "If the feed contains both a torrent link and a magnet link, prefer magnet link")
 
+    def on_checkbox_adaptive_interval_query_tooltip(self, widget, x, y, keyboard_mode, tooltip):
+        return set_tooltip_markup(
+            tooltip, ("Start with the 'update time', and then update the RSS Feed more often if new items "
+                      "appear often, and less often if the feed rarely changes. Not used when obeying TTL."))
+
     def on_checkbox_run_on_startup_query_tooltip(self, widget, x, y, keyboard_mode, tooltip):
         return set_tooltip_markup(
             tooltip, ("By checking this, the feed will be fetched when deluge is started. "
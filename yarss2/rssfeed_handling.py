@@ -7,13 +7,16 @@
 # See LICENSE for more details.
 #
 import re
+import threading
+import time
 
 import attr
 
 from deluge.error import DelugeError
 
 from yarss2.util import common, http
-from yarss2.yarss_config import get_user_agent
+from yarss2.yarss_config import (DEFAULT_CONNECT_TIMEOUT, DEFAULT_MAX_FEED_SIZE, DEFAULT_READ_TIMEOUT,
+                                 get_rssfeed_timeouts, get_user_agent)
 
 
 def _parse_size(string):
@@ -99,35 +102,139 @@ def atoma_result_to_dict(atoma_result):
     return result
 
 
+def parse_rss_stream(stream):
+    """Parse the RSS feed read from the file like object stream incrementally.
+    Each item is converted as soon as its end tag has been parsed, and is then removed
+    from the tree, so only the channel element and the converted items are kept in memory.
+    Returns an atoma RSSChannel.
+    """
+    import atoma
+    from defusedxml.ElementTree import ParseError, iterparse
+
+    items = []
+    root = channel = None
+    depth = 0
+    try:
+        for event, elem in iterparse(stream, events=("start", "end")):
+            if event == "start":
+                depth += 1
+                if depth == 1:
+                    root = elem
+                elif depth == 2 and elem.tag == "channel" and channel is None:
+                    channel = elem
+                continue
+            if depth == 3 and elem.tag == "item" and channel is not None:
+                items.append(atoma.rss._get_item(elem))
+                channel.remove(elem)
+            depth -= 1
+    except ParseError:
+        raise atoma.FeedXMLError('Not a valid XML document')
+    # The items have been removed, so this only parses the channel elements
+    atoma_result = atoma.rss._parse_rss(root)
+    atoma_result.items = items
+    return atoma_result
+
+
 def fetch_and_parse_rssfeed_atom(url_file_stream_or_string, site_cookies_dict=None,
-                                 user_agent=None, request_headers=None, timeout=10):
-    result = http.download_file(url_file_stream_or_string, site_cookies_dict=site_cookies_dict,
-                                user_agent=user_agent, request_headers=request_headers, timeout=timeout)
+                                 user_agent=None, request_headers=None,
+                                 timeout=(DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT), etag=None, modified=None,
+                                 max_size=DEFAULT_MAX_FEED_SIZE, deadline=None, prefetched=None):
+    """If etag or modified is given, the feed is only downloaded if it has changed.
+    If the server answers 304 Not Modified, the feed is not parsed, and the result
+    has no items and not_modified set to True.
+
+    timeout is a number or a tuple of (connect timeout, read timeout) in seconds.
+
+    Feeds served over http(s) are parsed while they are downloaded, and the download
+    is aborted with http.FeedTooLargeError when the body is larger than max_size bytes,
+    and with http.DeadlineExceededError if it is still running at deadline (a time.monotonic() value).
+
+    prefetched is the result of a download of the feed done elsewhere (see yarss2.util.twisted_http),
+    which is parsed instead of downloading the feed. If it is an exception, the download failed,
+    and the exception is raised.
+    """
+    start_time = time.monotonic()
+    stream = None
+    if prefetched is not None:
+        if isinstance(prefetched, Exception):
+            raise prefetched
+        result = prefetched
+    elif http.is_http_url(url_file_stream_or_string):
+        if site_cookies_dict:
+            request_headers = dict(request_headers or {}, **http.get_cookie_header(site_cookies_dict))
+        stream = http.open_feed_stream(url_file_stream_or_string, etag=etag, modified=modified,
+                                       user_agent=user_agent, request_headers=request_headers,
+                                       timeout=timeout, max_size=max_size, deadline=deadline)
+        result = stream.result
+    else:
+        result = http.download_file(url_file_stream_or_string, site_cookies_dict=site_cookies_dict,
+                                    etag=etag, modified=modified, user_agent=user_agent,
+                                    request_headers=request_headers, timeout=timeout)
+    fetched_time = time.monotonic()
     import atoma
     atoma.rss.supported_rss_versions = []
     parsed_feeds = {}
 
+    rate_limited = result.get('status', None) in http.RATE_LIMIT_STATUS_CODES
     try:
-        atoma_result = atoma.parse_rss_bytes(result['content'])
-        parsed_feeds = atoma_result_to_dict(atoma_result)
+        if result.get('status', None) == 304:
+            parsed_feeds = {'items': [], 'bozo': 0, 'feed': {}, 'not_modified': True}
+        elif stream is not None:
+            parsed_feeds = atoma_result_to_dict(parse_rss_stream(stream))
+        else:
+            atoma_result = atoma.parse_rss_bytes(result['content'])
+            parsed_feeds = atoma_result_to_dict(atoma_result)
     except atoma.FeedXMLError as err:
-        readable_body = http.clean_html_body(result['content'])
+        # Only the start of a streamed body is kept
+        content = stream.prefix if stream is not None else result['content']
+        readable_body = http.clean_html_body(content)
         parsed_feeds["raw_result"] = readable_body
         parsed_feeds["bozo"] = 1
         parsed_feeds["feed"] = {}
         parsed_feeds["items"] = []
         parsed_feeds["bozo_exception"] = err
+        rate_limited = rate_limited or http.is_rate_limit_page(content)
+    finally:
+        if stream is not None:
+            stream.close()
+    parsed_time = time.monotonic()
+
+    if stream is not None:
+        # The time spent waiting for the body is download time, the rest is parse time
+        fetch_duration = stream.read_duration
+        parse_duration = parsed_time - start_time - stream.read_duration
+        size = stream.bytes_read
+        compressed_size = stream.compressed_bytes_read
+    else:
+        fetch_duration = result.get('fetch_duration', fetched_time - start_time)
+        parse_duration = parsed_time - fetched_time
+        size = len(result['content']) if result['content'] else 0
+        compressed_size = result.get('compressed_bytes', size)
 
     parsed_feeds['parser'] = "atoma"
+    # The validators to send with the next request for the feed
+    parsed_feeds['etag'] = result.get('etag', None)
+    parsed_feeds['modified'] = result.get('modified', None)
+    parsed_feeds['fetch_stats'] = {
+        'fetch_duration': fetch_duration,
+        'parse_duration': max(parse_duration, 0.0),
+        'bytes': size,
+        'compressed_bytes': compressed_size,
+        'content_encoding': result['headers'].get('content-encoding', None),
+        'status': result.get('status', None),
+        'retry_after': http.get_retry_after(result['headers']),
+        'rate_limited': rate_limited,
+    }
     return parsed_feeds
 
 
 def fetch_and_parse_rssfeed_feedparser(url_file_stream_or_string, site_cookies_dict=None,
-                                       user_agent=None, request_headers=None, timeout=10):
+                                       user_agent=None, request_headers=None,
+                                       timeout=(DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT)):
     from yarss2.lib.feedparser import api as feedparser
 
     parsed_feed = feedparser.parse(url_file_stream_or_string, request_headers=request_headers,
-                                   agent=user_agent, timeout=10)
+                                   agent=user_agent, timeout=http.get_socket_timeout(timeout))
     parsed_feed['parser'] = "feedparser"
     return parsed_feed
 
@@ -139,6 +246,34 @@ class RSSFeedHandler(object):
 
     def __init__(self, log):
         self.log = log
+        # The ETag and Last-Modified values of the last successful update of each RSS Feed
+        self.http_validators = {}
+        self._validators_lock = threading.Lock()
+
+    def get_http_validators(self, rssfeed_key, url):
+        """Returns the (etag, modified) values stored for the RSS Feed, or (None, None)
+        if there are none, or if they were stored for another URL."""
+        with self._validators_lock:
+            validators = self.http_validators.get(rssfeed_key, None)
+        if validators is None or validators["url"] != url:
+            return None, None
+        return validators["etag"], validators["modified"]
+
+    def set_http_validators(self, rssfeed_key, url, etag, modified):
+        with self._validators_lock:
+            if etag is None and modified is None:
+                self.http_validators.pop(rssfeed_key, None)
+            else:
+                self.http_validators[rssfeed_key] = {"url": url, "etag": etag, "modified": modified}
+
+    def clear_http_validators(self, rssfeed_key=None):
+        """Forget the stored validators of the RSS Feed (or of all the RSS Feeds if rssfeed_key is None),
+        so the next update will download and match the whole feed."""
+        with self._validators_lock:
+            if rssfeed_key is None:
+                self.http_validators.clear()
+            else:
+                self.http_validators.pop(rssfeed_key, None)
 
     def get_link(self, item):
         link = None
@@ -163,10 +298,17 @@ class RSSFeedHandler(object):
     def get_size(self, item):
         return _get_size(item)
 
-    def get_rssfeed_parsed(self, rssfeed_data, site_cookies_dict=None, user_agent=None):
+    def get_rssfeed_parsed(self, rssfeed_data, site_cookies_dict=None, user_agent=None, etag=None, modified=None,
+                           max_size=DEFAULT_MAX_FEED_SIZE, general_config=None, deadline=None, prefetched=None):
         """
         rssfeed_data: A dictionary containing rss feed data as stored in the YaRSS2 config.
         site_cookies_dict: A dictionary of cookie values to be used for this rssfeed.
+        etag, modified: The validators from the last fetch of the feed, if any.
+        max_size: The maximum size of the feed in bytes.
+        general_config: The general config, with the default timeouts for the RSS Feed.
+        deadline: The time.monotonic() value at which the fetch is aborted,
+                  by default after the update deadline of the RSS Feed.
+        prefetched: The result of a download of the RSS Feed done elsewhere, to parse instead.
         """
         return_dict = {}
         rssfeeds_dict = {}
@@ -180,10 +322,14 @@ class RSSFeedHandler(object):
         self.log.info("Fetching RSS Feed: '%s' with Cookie: '%s' and User-agent: '%s'." %
                       (rssfeed_data["name"], http.get_cookie_header(cookie_header), user_agent))
 
-        # Will abort after 10 seconds if server doesn't answer
+        timeout, update_deadline = get_rssfeed_timeouts(rssfeed_data, general_config)
+        if deadline is None:
+            deadline = time.monotonic() + update_deadline
         try:
             parsed_feed = fetch_and_parse_rssfeed(rssfeed_data["url"], user_agent=user_agent,
-                                                  request_headers=cookie_header, timeout=10)
+                                                  request_headers=cookie_header, timeout=timeout,
+                                                  etag=etag, modified=modified, max_size=max_size,
+                                                  deadline=deadline, prefetched=prefetched)
         except Exception as e:
             self.log.warning("Exception occured in feedparser: " + str(e))
             self.log.warning("Feedparser was called with url: '%s' using cookies: '%s' and User-agent: '%s'" %
@@ -192,6 +338,12 @@ class RSSFeedHandler(object):
             raise DelugeError("Exception occured in feedparser: " + str(e))
 
         return_dict["raw_result"] = parsed_feed
+        if "fetch_stats" in parsed_feed:
+            return_dict["fetch_stats"] = parsed_feed["fetch_stats"]
+        return_dict["etag"] = parsed_feed.get("etag", None)
+        return_dict["modified"] = parsed_feed.get("modified", None)
+        if parsed_feed.get("not_modified", False):
+            return_dict["not_modified"] = True
 
         # Error parsing
         if parsed_feed["bozo"] == 1:
@@ -336,16 +488,57 @@ class RSSFeedHandler(object):
 
         return matching_items, message
 
-    def fetch_feed_torrents(self, config, rssfeed_key, subscription_key=None):
+    def get_feed_request(self, config, rssfeed_key, subscription_key=None):
+        """Returns the request fetch_feed_torrents makes for the RSS Feed, as a dict with
+        the url, headers, timeout, max_size and deadline, for downloading the feed with
+        another HTTP client and passing the result to fetch_feed_torrents as prefetched.
+        Returns None if the feed would not be fetched, or is not served over http(s).
+        """
+        if rssfeed_key is None:
+            rssfeed_key = config["subscriptions"][subscription_key]["rssfeed_key"]
+        elif config["rssfeeds"][rssfeed_key]["active"] is False:
+            return None
+        rssfeed_data = config["rssfeeds"][rssfeed_key]
+        if not http.is_http_url(rssfeed_data["url"]):
+            return None
+        # The feed is only fetched when an active subscription is run
+        for key, subscription_data in config["subscriptions"].items():
+            if subscription_key is not None and subscription_key != key:
+                continue
+            if subscription_data["rssfeed_key"] == rssfeed_key and subscription_data["active"] is True:
+                break
+        else:
+            return None
+
+        etag, modified = None, None
+        if subscription_key is None:
+            etag, modified = self.get_http_validators(rssfeed_key, rssfeed_data["url"])
+        site_cookies_dict = http.get_matching_cookies_dict(config["cookies"], rssfeed_data["site"])
+        cookie_header = http.get_cookie_header(site_cookies_dict) if site_cookies_dict else None
+        general_config = config.get("general", {})
+        timeout, update_deadline = get_rssfeed_timeouts(rssfeed_data, general_config)
+        return {"url": rssfeed_data["url"],
+                "headers": http.get_feed_request_headers(etag, modified,
+                                                         user_agent=get_user_agent(rssfeed_data=rssfeed_data),
+                                                         request_headers=cookie_header),
+                "timeout": timeout,
+                "max_size": general_config.get("max_feed_size", DEFAULT_MAX_FEED_SIZE),
+                "deadline": time.monotonic() + update_deadline}
+
+    def fetch_feed_torrents(self, config, rssfeed_key, subscription_key=None, prefetched=None):
         """Called to fetch torrents for a feed
         If rssfeed_key is not None, all subscriptions linked to that RSS Feed
         will be run.
         If rssfeed_key is None, only the subscription with key == subscription_key
         will be run
+        prefetched is the result of the request from get_feed_request, if the feed
+        was downloaded elsewhere.
         """
         fetch_data = {}
+        fetch_data["prefetched"] = prefetched
         fetch_data["matching_torrents"] = []
         fetch_data["rssfeed_items"] = None
+        fetch_data["match_duration"] = 0.0
 
         if rssfeed_key is None:
             if subscription_key is None:
@@ -360,10 +553,19 @@ class RSSFeedHandler(object):
         rssfeed_data = config["rssfeeds"][rssfeed_key]
         fetch_data["site_cookies_dict"] = http.get_matching_cookies_dict(config["cookies"], rssfeed_data["site"])
         fetch_data["user_agent"] = get_user_agent(rssfeed_data=rssfeed_data)
+        fetch_data["general_config"] = config.get("general", {})
+        fetch_data["max_feed_size"] = fetch_data["general_config"].get("max_feed_size", DEFAULT_MAX_FEED_SIZE)
+        fetch_data["timeout"], fetch_data["update_deadline"] = get_rssfeed_timeouts(rssfeed_data,
+                                                                                    fetch_data["general_config"])
+        fetch_data["deadline"] = time.monotonic() + fetch_data["update_deadline"]
 
         self.log.info("Update handler executed on RSS Feed '%s (%s)' (Update interval %d min)" %
                       (rssfeed_data["name"], rssfeed_data["site"], rssfeed_data["update_interval"]))
 
+        # Subscriptions run manually always match the whole feed
+        if subscription_key is None:
+            fetch_data["etag"], fetch_data["modified"] = self.get_http_validators(rssfeed_key, rssfeed_data["url"])
+
         for key in config["subscriptions"].keys():
             # subscription_key is given, only that subscription will be run
             if subscription_key is not None and subscription_key != key:
@@ -373,6 +575,10 @@ class RSSFeedHandler(object):
                 self.fetch_feed(subscription_data, rssfeed_data, fetch_data)
 
         if subscription_key is None:
+            if "error" in fetch_data:
+                self.clear_http_validators(rssfeed_key)
+            elif "http_validators" in fetch_data:
+                self.set_http_validators(rssfeed_key, rssfeed_data["url"], *fetch_data["http_validators"])
             # Update last_update value of the rssfeed only when rssfeed is run by the timer,
             # not when a subscription is run manually by the user.
             # Don't need microseconds. Remove because it requires changes to the GUI to not display them
@@ -407,14 +613,30 @@ class RSSFeedHandler(object):
         """Search a feed with config 'subscription_data'"""
         self.log.info("Fetching subscription '%s'." % subscription_data["name"])
 
+        # Feed has not changed since the last update, so there is nothing new to match
+        if fetch_data.get("not_modified", False):
+            return
         # Feed has not yet been fetched.
         if fetch_data["rssfeed_items"] is None:
             rssfeed_parsed = self.get_rssfeed_parsed(rssfeed_data, site_cookies_dict=fetch_data["site_cookies_dict"],
-                                                     user_agent=fetch_data["user_agent"])
+                                                     user_agent=fetch_data["user_agent"],
+                                                     etag=fetch_data.get("etag", None),
+                                                     modified=fetch_data.get("modified", None),
+                                                     max_size=fetch_data["max_feed_size"],
+                                                     general_config=fetch_data["general_config"],
+                                                     deadline=fetch_data["deadline"],
+                                                     prefetched=fetch_data.get("prefetched", None))
             if rssfeed_parsed is None:
                 return
+            fetch_data["fetch_stats"] = rssfeed_parsed.get("fetch_stats", None)
+            if rssfeed_parsed.get("not_modified", False):
+                self.log.info("RSS Feed '%s' has not changed since the last update." % rssfeed_data["name"])
+                fetch_data["not_modified"] = True
+                return
+            fetch_data["http_validators"] = (rssfeed_parsed.get("etag", None), rssfeed_parsed.get("modified", None))
             if "bozo_exception" in rssfeed_parsed:
                 self.log.warning("bozo_exception when parsing rssfeed: %s" % str(rssfeed_parsed["bozo_exception"]))
+                fetch_data["error"] = "Failed to parse RSS Feed: %s" % str(rssfeed_parsed["bozo_exception"])
             if "items" in rssfeed_parsed:
                 fetch_data["rssfeed_items"] = rssfeed_parsed["items"]
                 self.handle_ttl(rssfeed_data, rssfeed_parsed, fetch_data)
@@ -425,7 +647,9 @@ class RSSFeedHandler(object):
         # but they are only for testing in the DialogSubscription)
         options = subscription_data.copy()
         del options["custom_text_lines"]
+        match_start_time = time.monotonic()
         matches, message = self.update_rssfeeds_dict_matching(fetch_data["rssfeed_items"], options=options)
+        fetch_data["match_duration"] += time.monotonic() - match_start_time
         self.log.info("%d items in feed, %d matches the filter." %
                       (len(fetch_data["rssfeed_items"]), len(matches.keys())))
         last_match_dt = common.isodate_to_datetime(subscription_data["last_match"])
@@ -448,4 +672,6 @@ class RSSFeedHandler(object):
                                                     "site_cookies_dict": fetch_data["site_cookies_dict"],
                                                     "user_agent": fetch_data["user_agent"],
                                                     "referrer": rssfeed_data["url"],
+                                                    "timeout": fetch_data["timeout"],
+                                                    "update_deadline": fetch_data["update_deadline"],
                                                     "subscription_data": subscription_data})
@@ -7,95 +7,295 @@
 # See LICENSE for more details.
 #
 
+import heapq
+import itertools
+import random
+import sys
+import threading
+import time
 import traceback
+from collections import OrderedDict, deque
 
 import twisted.internet.defer as defer
-from twisted.internet import threads
-from twisted.internet.task import LoopingCall
+from twisted.internet import reactor, threads
+from twisted.python import threadable
 from twisted.python.failure import Failure
 
 import deluge.component as component
+from deluge.error import DelugeError
 
 from yarss2.rssfeed_handling import RSSFeedHandler
 from yarss2.torrent_handling import TorrentHandler
-from yarss2.yarss_config import YARSSConfigChangedEvent
+from yarss2.util import http
+from yarss2.yarss_config import (DEFAULT_ADAPTIVE_MAX_INTERVAL, DEFAULT_ADAPTIVE_MIN_INTERVAL,
+                                 DEFAULT_CIRCUIT_BREAKER_BASE_DELAY, DEFAULT_CIRCUIT_BREAKER_MAX_DELAY,
+                                 DEFAULT_CIRCUIT_BREAKER_THRESHOLD, DEFAULT_HTTP_ENGINE,
+                                 DEFAULT_MAX_CONCURRENT_DOWNLOADS, DEFAULT_MAX_CONCURRENT_FETCHES,
+                                 DEFAULT_MAX_CONCURRENT_FETCHES_PER_HOST, DEFAULT_MAX_FEED_SIZE,
+                                 DEFAULT_MAX_QUEUED_DOWNLOADS,
+                                 DEFAULT_MAX_QUEUED_UPDATES, DEFAULT_MAX_TORRENT_DOWNLOADS_PER_HOST,
+                                 DEFAULT_METRICS_HISTORY_SIZE,
+                                 DEFAULT_OVERLOAD_DELAY, DEFAULT_OVERLOAD_POLICY, DEFAULT_STARTUP_UPDATE_WINDOW,
+                                 DEFAULT_TORRENT_DOWNLOAD_WORKERS, DEFAULT_UPDATE_JITTER_PERCENT,
+                                 OVERLOAD_POLICIES, YARSSConfigChangedEvent)
+
+
+# Lanes of the run queue, in order of priority. Jobs started by the user (manual runs and
+# previews) are run before the updates started by the timers.
+RUN_LANE_INTERACTIVE = "interactive"
+RUN_LANE_TIMER = "timer"
+RUN_LANES = (RUN_LANE_INTERACTIVE, RUN_LANE_TIMER)
 
 
 class RSSFeedScheduler(object):
-    """Handles scheduling the RSS Feed fetches."""
+    """Handles scheduling the RSS Feed fetches.
+
+    The next update time of each RSS Feed is kept in a heap, and a single
+    delayed call is scheduled in the reactor for the feed that is due first.
+
+    An update runs through three stages: the run queue fetches, parses and matches
+    the RSS Feed, the download stage downloads the matching torrent files, and the
+    add stage adds the torrents to Deluge in the reactor thread. No more RSS Feeds
+    are fetched while the queue of the download stage is full.
+
+    When max_queued_updates timer updates are waiting in the run queue, the updates
+    that are due are handled by the overload policy: "skip" drops the update,
+    "coalesce" keeps one pending update for each RSS Feed, which is queued when
+    there is room in the run queue, and "delay" reschedules the RSS Feed to be
+    updated after overload_delay seconds.
+
+    Circuit breakers for each RSS Feed and each host stop the timer updates of
+    feeds that keep failing, with an exponential backoff, and of hosts that answer
+    that they get too many requests, for as long as they ask (Retry-After).
 
-    def __init__(self, config, logger):
+    With the "twisted" http_engine, the RSS Feeds and torrent files are downloaded with
+    Twisted's non-blocking HTTP client in the reactor thread, and only the parsing and
+    matching of the RSS Feeds is done in threads.
+    """
+
+    def __init__(self, config, logger, clock=None):
         self.yarss_config = config
         self.rssfeed_timers = {}
-        self.run_queue = RSSFeedRunQueue()
         self.log = logger
+        self.clock = clock if clock is not None else reactor
+        self.run_queue = RSSFeedRunQueue(*self._get_run_queue_limits(), logger=logger, clock=self.clock)
+        self.poll_stats = RSSFeedPollStats()
+        self.metrics = RSSFeedMetrics(self._get_general_config_value("metrics_history_size",
+                                                                     DEFAULT_METRICS_HISTORY_SIZE))
+        self.download_stage = RSSFeedPipelineStage("Torrent download", self.download_torrents,
+                                                   *self._get_download_stage_limits(), in_thread=False,
+                                                   logger=logger)
+        self.add_stage = RSSFeedPipelineStage("Add torrents", self.add_torrents_callback, workers=1,
+                                              in_thread=False, logger=logger)
+        self.run_queue.accepting_func = self.download_stage.is_accepting
+        self.download_stage.on_space.append(self.run_queue.resume)
+        self.run_queue.on_job_finished.append(self._queue_coalesced_updates)
+        # Timer updates that are waiting for room in the run queue (the "coalesce" overload policy)
+        self._coalesced_updates = OrderedDict()
+        self.overload_stats = dict((policy, 0) for policy in OVERLOAD_POLICIES)
+        self.rssfeed_breaker = RSSFeedCircuitBreaker(self.clock, *self._get_circuit_breaker_config())
+        self.host_breaker = RSSFeedCircuitBreaker(self.clock, *self._get_circuit_breaker_config())
+        self.circuit_open_skips = 0
+        http.set_session_pool_limits(*self._get_session_pool_limits())
+        # The Twisted HTTP client, created when the "twisted" http_engine is first used
+        self._http_client = None
         self.rssfeedhandler = RSSFeedHandler(logger)
         self.torrent_handler = TorrentHandler(logger)
         # To make it possible to disable adding torrents in testing
         self.add_torrents_func = self.torrent_handler.add_torrents
+        # Heap of (next update time, timer id, rssfeed key)
+        self._timer_heap = []
+        self._timer_ids = itertools.count()
+        self._timer_lock = threading.Lock()
+        self._timer_call = None
+        self._timer_call_time = None
+        self._timers_enabled = False
 
     def enable_timers(self):
-        """Creates the LoopingCall timers, one for each RSS Feed"""
+        """Schedules the timers, one for each RSS Feed"""
+        self._timers_enabled = True
         config = self.yarss_config.get_config()
         for key in config["rssfeeds"]:
             rssfeed = config["rssfeeds"][key]
             self.set_timer(rssfeed["key"], rssfeed['update_interval'], rssfeed["update_on_startup"])
             self.log.info("Scheduled RSS Feed '%s' with interval %s" %
                           (rssfeed["name"], rssfeed["update_interval"]))
+        self._schedule_next_timer()
 
     def disable_timers(self):
-        for key in list(self.rssfeed_timers.keys()):
-            self.rssfeed_timers[key]["timer"].stop()
-            del self.rssfeed_timers[key]
+        self._timers_enabled = False
+        self._coalesced_updates.clear()
+        with self._timer_lock:
+            self.rssfeed_timers.clear()
+            del self._timer_heap[:]
+        if self._timer_call is not None and self._timer_call.active():
+            self._timer_call.cancel()
+        self._timer_call = None
+        http.close_session()
+        if self._http_client is not None:
+            self._http_client.close()
+            self._http_client = None
+
+    def _get_general_config_value(self, key, default):
+        return self.yarss_config.get_config().get("general", {}).get(key, default)
+
+    def _get_update_delay(self, interval):
+        """Returns the number of seconds until the next update of a feed with
+        the interval (in minutes). A random delay is added to spread the updates
+        of feeds that were scheduled at the same time."""
+        jitter_percent = self._get_general_config_value("update_jitter_percent", DEFAULT_UPDATE_JITTER_PERCENT)
+        return interval * 60 * (1 + random.uniform(0, jitter_percent / 100.0))
+
+    def _get_startup_delay(self):
+        """Returns the number of seconds until a feed that updates on startup is run.
+        The feeds are spread randomly over the startup window instead of all being fetched at once."""
+        return random.uniform(0, self._get_general_config_value("startup_update_window",
+                                                                DEFAULT_STARTUP_UPDATE_WINDOW))
 
     def set_timer(self, key, interval, update_on_startup=False):
-        """Schedule a timer for the specified interval."""
+        """Schedule a timer for the specified interval.
+        If update_on_startup is True, the first update is run within the startup window.
+        """
         try:
             interval = int(interval)
         except ValueError:
             self.log.error("Failed to convert interval '%s' to int!" % str(interval))
             return False
-        # Already exists, so reschedule
-        if key in self.rssfeed_timers:
-            try:
-                self.rssfeed_timers[key]["timer"].stop()
-            except AssertionError as e:
-                self.log.warning("AssertionError:", e)
-                return False
-            self.rssfeed_timers[key]["update_interval"] = interval
-        else:
-            # New timer
-            # Second argument, the rssfeedkey is passed as argument to the callback method
-            timer = LoopingCall(self.queue_rssfeed_update, key)
-            self.rssfeed_timers[key] = {"timer": timer, "update_interval": interval}
-        self.rssfeed_timers[key]["timer"].start(interval * 60, now=update_on_startup)  # Multiply to get seconds
+        delay = self._get_startup_delay() if update_on_startup else self._get_update_delay(interval)
+        with self._timer_lock:
+            self._push_timer(key, interval, self.clock.seconds() + delay)
+        self._call_in_reactor_thread(self._schedule_next_timer)
         return True
 
+    def _push_timer(self, key, interval, next_update):
+        """Add the timer to the heap. Any previous heap entry of the timer becomes stale.
+        Must be called with the timer lock held."""
+        timer_id = next(self._timer_ids)
+        self.rssfeed_timers[key] = {"update_interval": interval, "next_update": next_update, "id": timer_id}
+        heapq.heappush(self._timer_heap, (next_update, timer_id, key))
+
+    def _is_stale(self, entry):
+        timer = self.rssfeed_timers.get(entry[2])
+        return timer is None or timer["id"] != entry[1]
+
     def delete_timer(self, key):
         """Delete timer with the specified key."""
-        if key not in self.rssfeed_timers:
-            self.log.warning("Cannot delete timer. No timer with key %s" % key)
-            return False
-        self.rssfeed_timers[key]["timer"].stop()
-        del self.rssfeed_timers[key]
+        with self._timer_lock:
+            if key not in self.rssfeed_timers:
+                self.log.warning("Cannot delete timer. No timer with key %s" % key)
+                return False
+            # The entry in the heap is skipped when it is due
+            del self.rssfeed_timers[key]
+        self.poll_stats.delete(key)
+        self.metrics.delete(key)
+        self.rssfeed_breaker.delete(key)
         return True
 
-    def rssfeed_update_handler_safe(self, rssfeed_key=None, subscription_key=None):
+    def _call_in_reactor_thread(self, f, *args):
+        # Call directly when the reactor has not been started yet (ioThread is unset)
+        if threadable.ioThread is None or threadable.isInIOThread():
+            f(*args)
+        else:
+            reactor.callFromThread(f, *args)
+
+    def _schedule_next_timer(self):
+        """Schedule the delayed call for the timer that is due first"""
+        if not self._timers_enabled:
+            return
+        with self._timer_lock:
+            while self._timer_heap and self._is_stale(self._timer_heap[0]):
+                heapq.heappop(self._timer_heap)
+            next_update = self._timer_heap[0][0] if self._timer_heap else None
+        if self._timer_call is not None and self._timer_call.active():
+            if self._timer_call_time == next_update:
+                return
+            self._timer_call.cancel()
+        self._timer_call = None
+        if next_update is not None:
+            delay = max(0, next_update - self.clock.seconds())
+            self._timer_call = self.clock.callLater(delay, self._on_timer, next_update)
+            self._timer_call_time = next_update
+
+    def _on_timer(self, scheduled_time):
+        """Queue updates for the RSS Feeds that are due, and schedule their next update"""
+        self._timer_call = None
+        now = max(self.clock.seconds(), scheduled_time)
+        due_keys = []
+        with self._timer_lock:
+            while self._timer_heap and self._timer_heap[0][0] <= now:
+                entry = heapq.heappop(self._timer_heap)
+                if self._is_stale(entry):
+                    continue
+                key = entry[2]
+                interval = self.rssfeed_timers[key]["update_interval"]
+                self._push_timer(key, interval, now + self._get_update_delay(interval))
+                due_keys.append(key)
+        for key in due_keys:
+            self.queue_rssfeed_update(key)
+        self._schedule_next_timer()
+
+    def _get_http_engine(self):
+        return self._get_general_config_value("http_engine", DEFAULT_HTTP_ENGINE)
+
+    def _get_http_client(self):
+        if self._http_client is None:
+            from yarss2.util.twisted_http import TwistedHTTPClient
+            self._http_client = TwistedHTTPClient(pool_maxsize=self._get_session_pool_limits()[1])
+        return self._http_client
+
+    def rssfeed_update_handler_async(self, rssfeed_key=None, subscription_key=None):
         """
-        This function is called by the LoopingCall, and should avoid passing any
-        raised exceptions back to the loopingcall. This is to make sure the loopingcall
-        doesn't stop.
+        Called by the run queue in the reactor thread with the "twisted" http_engine.
+        The RSS Feed is downloaded with the Twisted HTTP client, and then parsed and
+        matched by rssfeed_update_handler_safe in a separate thread.
+        Feeds that are not served over http(s) are fetched in the thread.
         """
         try:
-            return self.rssfeed_update_handler(rssfeed_key=rssfeed_key, subscription_key=subscription_key)
+            request = self.rssfeedhandler.get_feed_request(self.yarss_config.get_config(), rssfeed_key,
+                                                           subscription_key=subscription_key)
+        except KeyError:
+            request = None
+        if request is None:
+            return threads.deferToThread(self.rssfeed_update_handler_safe, rssfeed_key=rssfeed_key,
+                                         subscription_key=subscription_key)
+
+        def update(prefetched):
+            return threads.deferToThread(self.rssfeed_update_handler_safe, rssfeed_key=rssfeed_key,
+                                         subscription_key=subscription_key, prefetched=prefetched)
+
+        d = defer.maybeDeferred(self._get_http_client().get, request["url"], headers=request["headers"],
+                                timeout=request["timeout"], max_size=request["max_size"],
+                                deadline=request["deadline"])
+        # A failed download is raised by the update handler, like a failed fetch in the thread
+        d.addErrback(lambda failure: failure.value)
+        d.addCallback(update)
+        return d
+
+    def rssfeed_update_handler_safe(self, rssfeed_key=None, subscription_key=None, prefetched=None):
+        """
+        This function is called by the run queue, and should avoid passing any
+        raised exceptions back to the queue.
+        """
+        start_time = time.monotonic()
+        try:
+            return self.rssfeed_update_handler(rssfeed_key=rssfeed_key, subscription_key=subscription_key,
+                                               prefetched=prefetched)
         except:  # noqa: E722 do not use bare 'except'
             traceback.print_exc()
             exc_str = traceback.format_exc()
             self.log.warning("An exception was thrown by the RSS update handler. Please report this bug!\n%s" % exc_str)
+            self.metrics.record_error(self.get_rssfeed_key(rssfeed_key, subscription_key),
+                                      exc_str.strip().splitlines()[-1], time.monotonic() - start_time,
+                                      manual=subscription_key is not None)
+            # Fetching the RSS Feed failed (e.g. timeout or connection refused)
+            host_failure = isinstance(sys.exc_info()[1], DelugeError)
+            self.record_circuit_breaker_result(rssfeed_key, subscription_key, {"error": exc_str},
+                                               host_failure=host_failure)
 
-    def rssfeed_update_handler(self, rssfeed_key=None, subscription_key=None):
+    def rssfeed_update_handler(self, rssfeed_key=None, subscription_key=None, prefetched=None):
         """Goes through all the feeds and runs the active ones.
         Multiple subscriptions on one RSS Feed will download the RSS feed page only once
+        prefetched is the result of the download of the RSS Feed in rssfeed_update_handler_async.
         """
         if subscription_key:
             self.log.info("Manually running Subscription '%s'" %
@@ -104,12 +304,19 @@ class RSSFeedScheduler(object):
             if self.yarss_config.get_config()["rssfeeds"][rssfeed_key]["active"] is False:
                 return
 
+        start_time = time.monotonic()
         fetch_result = self.rssfeedhandler.fetch_feed_torrents(self.yarss_config.get_config(), rssfeed_key,
-                                                               subscription_key=subscription_key)
-        matching_torrents = fetch_result["matching_torrents"]
-        # Fetching the torrent files. Do this slow task in non-main thread.
-        for torrent in matching_torrents:
-            torrent["torrent_download"] = self.torrent_handler.get_torrent(torrent)
+                                                               subscription_key=subscription_key,
+                                                               prefetched=prefetched)
+        self.metrics.record_update(self.get_rssfeed_key(rssfeed_key, subscription_key), fetch_result,
+                                   time.monotonic() - start_time, manual=subscription_key is not None)
+        self.record_circuit_breaker_result(rssfeed_key, subscription_key, fetch_result)
+        # Only the updates run by the timer are counted in the poll stats
+        if subscription_key is None:
+            stats = self.poll_stats.record_fetch(rssfeed_key, fetch_result["rssfeed_items"], self.clock.seconds(),
+                                                 not_modified=fetch_result.get("not_modified", False))
+            if "ttl" not in fetch_result:
+                self.update_adaptive_interval(rssfeed_key, stats)
 
         # Update TTL value?
         if "ttl" in fetch_result:
@@ -122,7 +329,7 @@ class RSSFeedScheduler(object):
             # Set new interval in config
             rssfeed["update_interval"] = fetch_result["ttl"]
             # Reschedule timer
-            self.set_timer(rssfeed_key, fetch_result["ttl"], rssfeed["update_on_startup"])
+            self.set_timer(rssfeed_key, fetch_result["ttl"])
         # Send YARSSConfigChangedEvent to GUI with updated config.
         try:
             # Tests throws KeyError for EventManager when running this method, so wrap this in try/except
@@ -136,9 +343,68 @@ class RSSFeedScheduler(object):
         return (self.add_torrents_func, save_subscription_func,
                 fetch_result["matching_torrents"], self.yarss_config.get_config())
 
+    def queue_torrent_downloads(self, args):
+        """Pass the results from rssfeed_update_handler on to the download stage and the add stage.
+        Returns a deferred which fires when the torrents have been added.
+        """
+        if args is None:
+            return None
+        d = self.download_stage.put(args)
+        d.addCallback(self.add_stage.put)
+        return d
+
+    def download_torrents(self, args):
+        """Called by the download stage in the reactor thread. Download the torrent files
+        in a thread, or with the Twisted HTTP client with the "twisted" http_engine."""
+        if self._get_http_engine() == "twisted":
+            return self.download_torrents_async(args)
+        return threads.deferToThread(self.download_torrents_safe, args)
+
+    def download_torrents_async(self, args):
+        """Download the torrent files of the matching torrents with the Twisted HTTP client.
+        Errors are logged and not passed back to the stage."""
+        add_torrents_func, save_subscription_func, matching_torrents, config = args
+
+        def downloaded(downloads):
+            for torrent, download in zip(matching_torrents, downloads):
+                torrent["torrent_download"] = download
+            return args
+
+        def failed(failure):
+            self.log.warning("An exception was thrown when downloading torrents. Please report this bug!\n%s" %
+                             failure.getTraceback())
+
+        d = defer.maybeDeferred(
+            self.torrent_handler.get_torrents_async, matching_torrents, self._get_http_client(),
+            max_workers=self._get_general_config_value("torrent_download_workers", DEFAULT_TORRENT_DOWNLOAD_WORKERS),
+            max_per_host=self._get_general_config_value("max_torrent_downloads_per_host",
+                                                        DEFAULT_MAX_TORRENT_DOWNLOADS_PER_HOST))
+        return d.addCallbacks(downloaded, failed)
+
+    def download_torrents_safe(self, args):
+        """Called in a thread by download_torrents. Download the torrent files of the matching
+        torrents in rssfeed_update_handler results. Exceptions are logged and not
+        passed back to the stage."""
+        try:
+            add_torrents_func, save_subscription_func, matching_torrents, config = args
+            # Fetching the torrent files. Do this slow task in non-main thread.
+            downloads = self.torrent_handler.get_torrents(
+                matching_torrents,
+                max_workers=self._get_general_config_value("torrent_download_workers",
+                                                           DEFAULT_TORRENT_DOWNLOAD_WORKERS),
+                max_per_host=self._get_general_config_value("max_torrent_downloads_per_host",
+                                                            DEFAULT_MAX_TORRENT_DOWNLOADS_PER_HOST))
+            for torrent, download in zip(matching_torrents, downloads):
+                torrent["torrent_download"] = download
+            return args
+        except:  # noqa: E722 do not use bare 'except'
+            exc_str = traceback.format_exc()
+            self.log.warning("An exception was thrown when downloading torrents. Please report this bug!\n%s" %
+                             exc_str)
+
     def add_torrents_callback(self, args):
         """
-        Called with the results from rssfeed_update_handler
+        Called by the add stage with the results from download_torrents
         add_torrents_func must be called on the main thread
 
         """
@@ -147,42 +413,759 @@ class RSSFeedScheduler(object):
         add_torrents_func, save_subscription_func, matching_torrents, config = args
         add_torrents_func(save_subscription_func, matching_torrents, config)
 
-    def queue_rssfeed_update(self, *args, **kwargs):
-        d = self.run_queue.push(self.rssfeed_update_handler_safe, *args, **kwargs)
-        d.addCallback(self.add_torrents_callback)
+    def update_adaptive_interval(self, rssfeed_key, stats):
+        """Reschedule the RSS Feed according to the rate of new items
+        if the feed has adaptive_interval enabled."""
+        rssfeed = self.yarss_config.get_config()["rssfeeds"][rssfeed_key]
+        if stats is None or not rssfeed.get("adaptive_interval") or rssfeed["obey_ttl"]:
+            return
+        timer = self.rssfeed_timers.get(rssfeed_key)
+        if timer is None:
+            return
+        interval = self.poll_stats.get_adaptive_interval(
+            stats, timer["update_interval"],
+            self._get_general_config_value("adaptive_min_interval", DEFAULT_ADAPTIVE_MIN_INTERVAL),
+            self._get_general_config_value("adaptive_max_interval", DEFAULT_ADAPTIVE_MAX_INTERVAL))
+        if interval == timer["update_interval"]:
+            return
+        self.log.info("Rescheduling RSS Feed '%s' with interval %d (%.2f new items per hour)." %
+                      (rssfeed["name"], interval, stats["new_items_per_hour"]))
+        self.set_timer(rssfeed_key, interval)
+
+    def _get_circuit_breaker_config(self):
+        return (self._get_general_config_value("circuit_breaker_threshold", DEFAULT_CIRCUIT_BREAKER_THRESHOLD),
+                self._get_general_config_value("circuit_breaker_base_delay", DEFAULT_CIRCUIT_BREAKER_BASE_DELAY),
+                self._get_general_config_value("circuit_breaker_max_delay", DEFAULT_CIRCUIT_BREAKER_MAX_DELAY))
+
+    def record_circuit_breaker_result(self, rssfeed_key, subscription_key, fetch_result, host_failure=False):
+        """Update the circuit breakers of the RSS Feed and its host with the result of an update.
+
+        An update fails on an exception, a parse error or an HTTP error status. Exceptions
+        (e.g. timeouts), server errors and rate limiting (HTTP 429 and 503, or an error page
+        saying too many requests) are also failures of the host.
+        """
+        if "fetch_stats" not in fetch_result and "error" not in fetch_result:
+            # The RSS Feed was not fetched
+            return
+        rssfeed_key = self.get_rssfeed_key(rssfeed_key, subscription_key)
+        host = self.get_rssfeed_host(rssfeed_key)
+        fetch_stats = fetch_result.get("fetch_stats", None) or {}
+        status = fetch_stats.get("status", None) or 0
+        rate_limited = fetch_stats.get("rate_limited", False)
+        retry_after = fetch_stats.get("retry_after", None) if rate_limited else None
+        host_failure = host_failure or rate_limited or status >= 500
+
+        if "error" not in fetch_result and status < 400 and not rate_limited:
+            self.rssfeed_breaker.record_success(rssfeed_key)
+            self.host_breaker.record_success(host)
+            return
+        name = self.get_job_name(rssfeed_key)
+        delay = self.rssfeed_breaker.record_failure(rssfeed_key, retry_after=retry_after, rate_limited=rate_limited)
+        if delay:
+            self.log.warning("%s failed %d times in a row. Not updating the RSS Feed for %d seconds." %
+                             (name, self.rssfeed_breaker.get_failures(rssfeed_key), delay))
+        if host_failure and host:
+            delay = self.host_breaker.record_failure(host, retry_after=retry_after, rate_limited=rate_limited)
+            if delay:
+                self.log.warning("Updates of RSS Feeds on '%s' failed %d times in a row%s. "
+                                 "Not updating RSS Feeds on the site for %d seconds." %
+                                 (host, self.host_breaker.get_failures(host),
+                                  " (too many requests)" if rate_limited else "", delay))
+
+    def is_circuit_open(self, rssfeed_key=None, subscription_key=None):
+        """Returns True if the circuit breaker of the RSS Feed or its host is open"""
+        rssfeed_key = self.get_rssfeed_key(rssfeed_key, subscription_key)
+        host = self.get_rssfeed_host(rssfeed_key)
+        return self.rssfeed_breaker.is_open(rssfeed_key) or (bool(host) and self.host_breaker.is_open(host))
+
+    def get_poll_stats(self):
+        """Returns the poll stats of the RSS Feeds, with the current update interval of each feed"""
+        stats = self.poll_stats.get_stats()
+        for key, timer in list(self.rssfeed_timers.items()):
+            if key in stats:
+                stats[key]["update_interval"] = timer["update_interval"]
+        return stats
+
+    def _get_run_queue_limits(self):
+        general_config = self.yarss_config.get_config().get("general", {})
+        return (general_config.get("max_concurrent_fetches", DEFAULT_MAX_CONCURRENT_FETCHES),
+                general_config.get("max_concurrent_fetches_per_host", DEFAULT_MAX_CONCURRENT_FETCHES_PER_HOST))
+
+    def _get_download_stage_limits(self):
+        general_config = self.yarss_config.get_config().get("general", {})
+        return (general_config.get("max_concurrent_downloads", DEFAULT_MAX_CONCURRENT_DOWNLOADS),
+                general_config.get("max_queued_downloads", DEFAULT_MAX_QUEUED_DOWNLOADS))
+
+    def _get_session_pool_limits(self):
+        """The shared HTTP session keeps open as many connections to each host
+        as there may be concurrent fetches or torrent downloads from the host"""
+        return (http.DEFAULT_SESSION_POOL_HOSTS,
+                max(self._get_general_config_value("max_concurrent_fetches_per_host",
+                                                   DEFAULT_MAX_CONCURRENT_FETCHES_PER_HOST),
+                    self._get_general_config_value("max_torrent_downloads_per_host",
+                                                   DEFAULT_MAX_TORRENT_DOWNLOADS_PER_HOST),
+                    1))
+
+    def update_run_queue_limits(self):
+        """Apply the concurrency limits in the general config to the run queue and the download stage"""
+        self.metrics.set_history_size(self._get_general_config_value("metrics_history_size",
+                                                                     DEFAULT_METRICS_HISTORY_SIZE))
+        self.rssfeed_breaker.set_limits(*self._get_circuit_breaker_config())
+        self.host_breaker.set_limits(*self._get_circuit_breaker_config())
+        self.download_stage.set_limits(*self._get_download_stage_limits())
+        self.run_queue.set_limits(*self._get_run_queue_limits())
+        http.set_session_pool_limits(*self._get_session_pool_limits())
+        if self._http_client is not None:
+            self._http_client.set_pool_maxsize(self._get_session_pool_limits()[1])
+
+    def get_rssfeed_key(self, rssfeed_key=None, subscription_key=None):
+        """Returns rssfeed_key, or the key of the RSS Feed of the subscription if rssfeed_key is None"""
+        if rssfeed_key is not None:
+            return rssfeed_key
+        try:
+            return self.yarss_config.get_config()["subscriptions"][subscription_key]["rssfeed_key"]
+        except KeyError:
+            return None
+
+    def get_rssfeed_host(self, rssfeed_key=None, subscription_key=None):
+        """Returns the host name of the RSS Feed, used to limit the number
+        of concurrent fetches on each site."""
+        try:
+            rssfeed_key = self.get_rssfeed_key(rssfeed_key, subscription_key)
+            return http.get_url_host(self.yarss_config.get_config()["rssfeeds"][rssfeed_key]["url"])
+        except KeyError:
+            return None
+
+    def get_job_name(self, rssfeed_key=None, subscription_key=None):
+        config = self.yarss_config.get_config()
+        try:
+            if subscription_key is not None:
+                return "Subscription '%s'" % config["subscriptions"][subscription_key]["name"]
+            return "RSS Feed '%s'" % config["rssfeeds"][rssfeed_key]["name"]
+        except KeyError:
+            return "RSS Feed update (%s, %s)" % (rssfeed_key, subscription_key)
+
+    def queue_rssfeed_update(self, rssfeed_key=None, subscription_key=None, lane=RUN_LANE_TIMER):
+        """Queue an update of the RSS Feed (or only the subscription if subscription_key is given).
+        If the same update is already waiting in the queue, the requests are merged so that
+        the feed is fetched only once, and all the returned deferreds get the same result.
+        Updates started by the user are queued in the interactive lane.
+        """
+        if lane == RUN_LANE_TIMER:
+            if self.is_circuit_open(rssfeed_key, subscription_key):
+                self.circuit_open_skips += 1
+                self.log.info("Skipping update of %s. Updates are paused after failures." %
+                              self.get_job_name(rssfeed_key, subscription_key))
+                return defer.succeed(None)
+            if self._is_overloaded((rssfeed_key, subscription_key)):
+                return self._handle_overload(rssfeed_key, subscription_key)
+        in_thread = self._get_http_engine() != "twisted"
+        job = RSSFeedRunJob(self.rssfeed_update_handler_safe if in_thread else self.rssfeed_update_handler_async,
+                            kwargs={"rssfeed_key": rssfeed_key, "subscription_key": subscription_key},
+                            host=self.get_rssfeed_host(rssfeed_key, subscription_key),
+                            key=(rssfeed_key, subscription_key),
+                            name=self.get_job_name(rssfeed_key, subscription_key),
+                            lane=lane, in_thread=in_thread)
+        job.deferred.addCallback(self.queue_torrent_downloads)
+        return self.run_queue.push_job(job)
+
+    def _is_overloaded(self, key):
+        """The run queue is overloaded when max_queued_updates timer updates are waiting.
+        An update that is already queued is merged, so it does not add to the queue."""
+        max_queued = self._get_general_config_value("max_queued_updates", DEFAULT_MAX_QUEUED_UPDATES)
+        if not max_queued or self.run_queue.is_queued(key):
+            return False
+        return self.run_queue.queued_count(RUN_LANE_TIMER) >= max_queued
+
+    def _handle_overload(self, rssfeed_key, subscription_key):
+        policy = self._get_general_config_value("overload_policy", DEFAULT_OVERLOAD_POLICY)
+        if policy not in OVERLOAD_POLICIES:
+            policy = DEFAULT_OVERLOAD_POLICY
+        self.overload_stats[policy] += 1
+        name = self.get_job_name(rssfeed_key, subscription_key)
+        if policy == "coalesce":
+            self._coalesced_updates[(rssfeed_key, subscription_key)] = True
+            self.log.info("The run queue is full (%d updates queued). %s will be queued when there is room." %
+                          (self.run_queue.queued_count(RUN_LANE_TIMER), name))
+        elif policy == "delay":
+            delay = self._get_general_config_value("overload_delay", DEFAULT_OVERLOAD_DELAY)
+            self._delay_timer(rssfeed_key, delay)
+            self.log.info("The run queue is full (%d updates queued). Delaying %s by %d seconds." %
+                          (self.run_queue.queued_count(RUN_LANE_TIMER), name, delay))
+        else:
+            self.log.info("The run queue is full (%d updates queued). Skipping update of %s." %
+                          (self.run_queue.queued_count(RUN_LANE_TIMER), name))
+        return defer.succeed(None)
+
+    def _delay_timer(self, key, delay):
+        """Update the RSS Feed after delay seconds, unless the timer is due before that"""
+        with self._timer_lock:
+            timer = self.rssfeed_timers.get(key)
+            next_update = self.clock.seconds() + delay
+            if timer is None or timer["next_update"] <= next_update:
+                return
+            self._push_timer(key, timer["update_interval"], next_update)
+        self._call_in_reactor_thread(self._schedule_next_timer)
+
+    def _queue_coalesced_updates(self):
+        """Queue the coalesced timer updates while there is room in the run queue"""
+        while self._coalesced_updates:
+            key = next(iter(self._coalesced_updates))
+            if self._is_overloaded(key):
+                break
+            del self._coalesced_updates[key]
+            rssfeed_key, subscription_key = key
+            if rssfeed_key in self.rssfeed_timers:
+                self.queue_rssfeed_update(rssfeed_key, subscription_key)
+
+    def get_run_queue_stats(self):
+        """Returns the stats of the lanes in the run queue and of the pipeline stages,
+        and the number of overload events for each overload policy."""
+        return {"lanes": self.run_queue.get_lane_stats(),
+                "download_stage": self.download_stage.get_stats(),
+                "add_stage": self.add_stage.get_stats(),
+                "coalesced_updates": len(self._coalesced_updates),
+                "overload_events": dict(self.overload_stats),
+                "circuit_open_skips": self.circuit_open_skips,
+                "circuit_breakers": {"rssfeeds": self.rssfeed_breaker.get_stats(),
+                                     "hosts": self.host_breaker.get_stats()}}
+
+    def queue_rssfeed_parsed(self, rssfeed_data, site_cookies_dict=None, user_agent=None):
+        """Queue fetching and parsing the RSS Feed for a preview in the GUI.
+        Returns a deferred which fires with the result of RSSFeedHandler.get_rssfeed_parsed
+        """
+        job = RSSFeedRunJob(self.rssfeedhandler.get_rssfeed_parsed, args=(rssfeed_data,),
+                            kwargs={"site_cookies_dict": site_cookies_dict, "user_agent": user_agent,
+                                    "max_size": self._get_general_config_value("max_feed_size",
+                                                                               DEFAULT_MAX_FEED_SIZE),
+                                    "general_config": self.yarss_config.get_config().get("general", {})},
+                            host=http.get_url_host(rssfeed_data["url"]),
+                            name="Preview of RSS Feed '%s'" % rssfeed_data.get("name", ""),
+                            lane=RUN_LANE_INTERACTIVE)
+        return self.run_queue.push_job(job)
+
+
+class RSSFeedPollStats(object):
+    """Keeps statistics on the new items found each time an RSS Feed is fetched.
+
+    The rate of new items is used to compute the update interval of the
+    feeds with adaptive_interval enabled.
+    """
+    # Weight of the latest fetch in the moving averages
+    smoothing = 0.3
+    # The adaptive interval aims at finding this many new items on each fetch
+    target_new_items_per_fetch = 1.0
+
+    def __init__(self):
+        self.stats = {}
+        self._item_ids = {}
+        self._lock = threading.Lock()
+
+    def record_fetch(self, key, rssfeed_items, now, not_modified=False):
+        """Update the stats of the RSS Feed with the items returned by a fetch.
+        If not_modified is True, the feed has the same items as on the previous fetch.
+        Returns a copy of the stats, or None if the items could not be compared with a previous fetch.
+        """
+        if key is None or (rssfeed_items is None and not not_modified):
+            return None
+        with self._lock:
+            previous_ids = self._item_ids.get(key)
+            if not_modified:
+                item_ids = previous_ids
+                if item_ids is None:
+                    return None
+            else:
+                item_ids = set(item["link"] for item in rssfeed_items.values() if item["link"] is not None)
+            self._item_ids[key] = item_ids
+            stats = self.stats.setdefault(key, {"fetches": 0, "new_items": 0, "last_new_items": None,
+                                                "new_items_per_fetch": None, "new_items_per_hour": None,
+                                                "last_fetch": None})
+            last_fetch = stats["last_fetch"]
+            stats["fetches"] += 1
+            stats["last_fetch"] = now
+            if previous_ids is None or last_fetch is None or now <= last_fetch:
+                return None
+            new_items = len(item_ids - previous_ids)
+            stats["new_items"] += new_items
+            stats["last_new_items"] = new_items
+            stats["new_items_per_fetch"] = self._average(stats["new_items_per_fetch"], new_items)
+            stats["new_items_per_hour"] = self._average(stats["new_items_per_hour"],
+                                                        new_items * 3600.0 / (now - last_fetch))
+            return dict(stats)
+
+    def _average(self, average, value):
+        if average is None:
+            return float(value)
+        return average + self.smoothing * (value - average)
+
+    def get_adaptive_interval(self, stats, interval, min_interval, max_interval):
+        """Returns the update interval (in minutes) at which the expected number of new items
+        on each fetch is target_new_items_per_fetch. The interval is changed by at most
+        a factor of two each time, and is kept within min_interval and max_interval.
+        """
+        rate = stats["new_items_per_hour"]
+        if rate > 0:
+            target = self.target_new_items_per_fetch * 60.0 / rate
+        else:
+            target = max_interval
+        target = min(max(target, interval / 2.0), interval * 2.0)
+        return int(round(min(max(target, min_interval, 1), max_interval)))
+
+    def delete(self, key):
+        with self._lock:
+            self.stats.pop(key, None)
+            self._item_ids.pop(key, None)
+
+    def get_stats(self):
+        with self._lock:
+            return dict((key, dict(stats)) for key, stats in self.stats.items())
+
+
+class RSSFeedMetrics(object):
+    """Keeps the metrics of the last history_size updates of each RSS Feed.
+
+    Each record has the durations (in seconds) of the whole update, and of fetching,
+    parsing and matching the feed, the number of bytes of the feed and the number
+    of (compressed) bytes downloaded, the content encoding, the HTTP status,
+    whether the feed was not modified, the number of items and matches, and the error, if any.
+    """
+    def __init__(self, history_size=DEFAULT_METRICS_HISTORY_SIZE):
+        self.history_size = history_size
+        self._history = {}
+        self._lock = threading.Lock()
+
+    def set_history_size(self, history_size):
+        with self._lock:
+            self.history_size = history_size
+            for key in list(self._history.keys()):
+                self._history[key] = deque(self._history[key], maxlen=history_size)
+
+    def record_update(self, key, fetch_result, duration, manual=False):
+        """Record the result of RSSFeedHandler.fetch_feed_torrents.
+        Nothing is recorded if the RSS Feed was not fetched."""
+        if "fetch_stats" not in fetch_result and "error" not in fetch_result:
+            return
+        fetch_stats = fetch_result.get("fetch_stats", None) or {}
+        items = fetch_result["rssfeed_items"]
+        self._add(key, {"duration": duration,
+                        "fetch_duration": fetch_stats.get("fetch_duration", None),
+                        "parse_duration": fetch_stats.get("parse_duration", None),
+                        "match_duration": fetch_result.get("match_duration", None),
+                        "bytes": fetch_stats.get("bytes", None),
+                        "compressed_bytes": fetch_stats.get("compressed_bytes", None),
+                        "content_encoding": fetch_stats.get("content_encoding", None),
+                        "status": fetch_stats.get("status", None),
+                        "not_modified": fetch_result.get("not_modified", False),
+                        "items": len(items) if items is not None else 0,
+                        "matches": len(fetch_result["matching_torrents"]),
+                        "error": fetch_result.get("error", None),
+                        "manual": manual})
+
+    def record_error(self, key, error, duration, manual=False):
+        """Record an update that failed with an exception"""
+        self._add(key, {"duration": duration, "fetch_duration": None, "parse_duration": None,
+                        "match_duration": None, "bytes": None, "compressed_bytes": None,
+                        "content_encoding": None, "status": None, "not_modified": False, "items": 0,
+                        "matches": 0, "error": error, "manual": manual})
+
+    def _add(self, key, record):
+        if key is None:
+            return
+        record["time"] = time.time()
+        with self._lock:
+            if key not in self._history:
+                self._history[key] = deque(maxlen=self.history_size)
+            self._history[key].append(record)
+
+    def delete(self, key):
+        with self._lock:
+            self._history.pop(key, None)
+
+    def get_metrics(self, key=None):
+        """Returns a summary and the history of the metrics of each RSS Feed,
+        or only of the RSS Feed with key if key is not None."""
+        with self._lock:
+            keys = list(self._history.keys()) if key is None else [k for k in (key,) if k in self._history]
+            history = dict((k, [dict(record) for record in self._history[k]]) for k in keys)
+        return dict((k, {"summary": self._summarize(records), "history": records})
+                    for k, records in history.items())
+
+    def _summarize(self, records):
+        def average(values):
+            values = [value for value in values if value is not None]
+            return sum(values) / len(values) if values else None
+
+        def maximum(values):
+            values = [value for value in values if value is not None]
+            return max(values) if values else None
+
+        errors = [record for record in records if record["error"] is not None]
+        last = records[-1] if records else {}
+        return {"updates": len(records),
+                "errors": len(errors),
+                "error_rate": float(len(errors)) / len(records) if records else 0.0,
+                "average_duration": average(record["duration"] for record in records),
+                "average_fetch_duration": average(record["fetch_duration"] for record in records),
+                "max_fetch_duration": maximum(record["fetch_duration"] for record in records),
+                "average_parse_duration": average(record["parse_duration"] for record in records),
+                "average_match_duration": average(record["match_duration"] for record in records),
+                "bytes": sum(record["bytes"] for record in records if record["bytes"] is not None),
+                "compressed_bytes": sum(record["compressed_bytes"] for record in records
+                                        if record["compressed_bytes"] is not None),
+                "matches": sum(record["matches"] for record in records),
+                "not_modified": sum(1 for record in records if record["not_modified"]),
+                "last_status": last.get("status", None),
+                "last_error": errors[-1]["error"] if errors else None}
+
+
+class RSSFeedCircuitBreaker(object):
+    """Counts the failed updates in a row for each key (RSS Feed or host).
+
+    After threshold failures in a row, the circuit is open for base_delay seconds,
+    and the delay is doubled for each failure after that, up to max_delay. When the
+    server asks the client to slow down (rate_limited), the circuit is opened at once,
+    for at least retry_after seconds if given. A successful update closes the circuit.
+    """
+    def __init__(self, clock, threshold=DEFAULT_CIRCUIT_BREAKER_THRESHOLD,
+                 base_delay=DEFAULT_CIRCUIT_BREAKER_BASE_DELAY, max_delay=DEFAULT_CIRCUIT_BREAKER_MAX_DELAY):
+        self.clock = clock
+        self.set_limits(threshold, base_delay, max_delay)
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def set_limits(self, threshold, base_delay, max_delay):
+        self.threshold = threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def record_success(self, key):
+        with self._lock:
+            self._states.pop(key, None)
+
+    def record_failure(self, key, retry_after=None, rate_limited=False):
+        """Count a failure. Returns the number of seconds the circuit is opened for, or None"""
+        with self._lock:
+            state = self._states.setdefault(key, {"failures": 0, "open_until": None, "opened": 0})
+            state["failures"] += 1
+            delay = None
+            if self.threshold and state["failures"] >= self.threshold:
+                delay = min(self.base_delay * 2 ** (state["failures"] - self.threshold), self.max_delay)
+            if rate_limited:
+                delay = max(delay or 0, retry_after if retry_after is not None else self.base_delay)
+            if not delay:
+                return None
+            state["open_until"] = self.clock.seconds() + delay
+            state["opened"] += 1
+            return delay
+
+    def is_open(self, key):
+        with self._lock:
+            state = self._states.get(key)
+            return state is not None and state["open_until"] is not None and \
+                self.clock.seconds() < state["open_until"]
+
+    def get_failures(self, key):
+        with self._lock:
+            state = self._states.get(key)
+            return state["failures"] if state else 0
+
+    def delete(self, key):
+        self.record_success(key)
+
+    def get_stats(self):
+        """Returns the failures in a row, the number of times the circuit has been opened,
+        and the seconds until the circuit closes (0 if closed), for each key with failures"""
+        now = self.clock.seconds()
+        with self._lock:
+            return dict((key, {"failures": state["failures"], "opened": state["opened"],
+                               "closes_in": max(0, state["open_until"] - now) if state["open_until"] else 0})
+                        for key, state in self._states.items())
+
+
+class RSSFeedRunJob(object):
+    """A function call to be run by the RSSFeedRunQueue.
+    host is the site the job fetches from, used to limit concurrent jobs per site.
+    key identifies the job, queued jobs with the same key are merged into one.
+    lane is the lane of the run queue the job waits in (see RUN_LANES).
+    f is called in a separate thread if in_thread is True, else in the reactor
+    thread, where it must not block (it may return a deferred).
+
+    Callbacks that must be run only once for the job are added to self.deferred.
+    Each caller pushing the job gets a separate deferred (see add_waiter) that
+    fires with the result after the callbacks on self.deferred have been run.
+    """
+    def __init__(self, f, args=(), kwargs=None, host=None, key=None, name=None, lane=RUN_LANE_TIMER,
+                 in_thread=True):
+        self.f = f
+        self.in_thread = in_thread
+        self.args = args
+        self.kwargs = kwargs if kwargs is not None else {}
+        self.host = host
+        self.key = key
+        self.name = name
+        self.lane = lane
+        self.queued_time = None
+        self.deferred = defer.Deferred()
+        self._waiters = []
+
+    def add_waiter(self):
+        d = defer.Deferred()
+        self._waiters.append(d)
         return d
 
+    def waiter_count(self):
+        return len(self._waiters)
+
+    def notify_waiters(self, result):
+        waiters, self._waiters = self._waiters, []
+        for d in waiters:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
 
 class RSSFeedRunQueue(object):
-    """Runs functions in separate threads. If a job is already running,
-    jobs pushed are queued until the running job has finished"""
-    def __init__(self, concurrent_max=1):
+    """Runs functions in separate threads. At most concurrent_max jobs are running
+    at the same time, and at most concurrent_max_per_host jobs for the same host.
+    Jobs pushed when no slot is available are queued until a running job has finished.
+
+    Queued jobs wait in separate lanes (see RUN_LANES), and the jobs in a lane are
+    started before the jobs in the lanes of lower priority. Within a lane, the queued
+    jobs are started in turn for each host, so that a site with many queued feeds
+    does not delay the feeds on the other sites.
+    """
+    def __init__(self, concurrent_max=1, concurrent_max_per_host=None, logger=None, clock=None):
         self.concurrentMax = concurrent_max
+        self.concurrent_max_per_host = concurrent_max_per_host
+        self.log = logger
+        self.clock = clock if clock is not None else reactor
         self._running = 0
-        self._queued = []
+        self._running_per_host = {}
+        # Queued jobs for each host, in each lane
+        self._queued = OrderedDict((lane, OrderedDict()) for lane in RUN_LANES)
+        # Queued jobs by job key
+        self._queued_keys = {}
+        # Counter of when each host last had a job started
+        self._host_turns = {}
+        self._turn = 0
+        # How long the started jobs waited in each lane
+        self._lane_stats = dict((lane, {"started": 0, "total_wait": 0.0, "max_wait": 0.0, "last_wait": None})
+                                for lane in RUN_LANES)
+        # Function returning False when the next stage cannot take more work.
+        # No queued jobs are started until it returns True and resume is called.
+        self.accepting_func = None
+        # Functions called after a job has finished and the next queued jobs have been started
+        self.on_job_finished = []
+
+    def set_limits(self, concurrent_max, concurrent_max_per_host=None):
+        self.concurrentMax = concurrent_max
+        self.concurrent_max_per_host = concurrent_max_per_host
+        self._run_queued()
 
     def push(self, f, *args, **kwargs):
         """Push job to queue"""
-        if self._running < self.concurrentMax:
-            return self._run(f, args, kwargs)
-        d = defer.Deferred()
-        self._queued.append((f, args, kwargs, d))
+        return self.push_job(RSSFeedRunJob(f, args, kwargs))
+
+    def push_job(self, job):
+        """Push a RSSFeedRunJob to the queue.
+        If a job with the same key is already queued (and not yet running), job is
+        dropped and the caller waits for the queued job instead. If job is in a lane
+        with higher priority, the queued job is moved to that lane.
+
+        Returns a deferred which fires with the result of the job.
+        """
+        queued_job = self._queued_keys.get(job.key) if job.key is not None else None
+        if queued_job is not None:
+            d = queued_job.add_waiter()
+            if RUN_LANES.index(job.lane) < RUN_LANES.index(queued_job.lane):
+                self._remove_queued(queued_job)
+                queued_job.lane = job.lane
+                self._add_queued(queued_job)
+            if self.log:
+                self.log.info("%s is already queued. Merging with the queued update "
+                              "(%d requests waiting, %d jobs queued)." %
+                              (queued_job.name, queued_job.waiter_count(), self.queued_count()))
+            self._run_queued()
+            return d
+        d = job.add_waiter()
+        job.queued_time = self.clock.seconds()
+        self._add_queued(job)
+        if job.key is not None:
+            self._queued_keys[job.key] = job
+        self._run_queued()
         return d
 
-    def _run(self, f, args, kwargs):
-        """Run function in separate thread"""
+    def _add_queued(self, job):
+        self._queued[job.lane].setdefault(job.host, []).append(job)
+
+    def _remove_queued(self, job):
+        jobs = self._queued[job.lane][job.host]
+        jobs.remove(job)
+        if not jobs:
+            del self._queued[job.lane][job.host]
+
+    def is_queued(self, key):
+        return key is not None and key in self._queued_keys
+
+    def queued_count(self, lane=None):
+        lanes = RUN_LANES if lane is None else (lane,)
+        return sum(len(jobs) for queued_lane in lanes for jobs in self._queued[queued_lane].values())
+
+    def get_lane_stats(self):
+        """Returns the number of queued and started jobs in each lane,
+        and how long (in seconds) the started jobs have waited in the lane"""
+        now = self.clock.seconds()
+        stats = {}
+        for lane in RUN_LANES:
+            lane_stats = dict(self._lane_stats[lane])
+            lane_stats["queued"] = self.queued_count(lane)
+            lane_stats["average_wait"] = (lane_stats["total_wait"] / lane_stats["started"]
+                                          if lane_stats["started"] else None)
+            waiting = [job.queued_time for jobs in self._queued[lane].values() for job in jobs]
+            lane_stats["oldest_queued_wait"] = now - min(waiting) if waiting else None
+            stats[lane] = lane_stats
+        return stats
+
+    def _host_available(self, host):
+        if self.concurrent_max_per_host is None:
+            return True
+        return self._running_per_host.get(host, 0) < self.concurrent_max_per_host
+
+    def _pop_next(self):
+        """Returns the next job to run, taken from the lane with the highest priority
+        that has a job for an available host. Within the lane, the job is taken from
+        the host that has waited the longest since a job was last started for it."""
+        for lane in RUN_LANES:
+            queued = self._queued[lane]
+            candidates = [host for host in queued if self._host_available(host)]
+            if candidates:
+                break
+        else:
+            return None
+        next_host = min(candidates, key=lambda host: self._host_turns.get(host, -1))
+        jobs = queued[next_host]
+        job = jobs.pop(0)
+        if not jobs:
+            del queued[next_host]
+        if job.key is not None:
+            del self._queued_keys[job.key]
+        self._host_turns[next_host] = self._turn
+        self._turn += 1
+        self._update_lane_stats(job)
+        return job
+
+    def _update_lane_stats(self, job):
+        wait = max(0.0, self.clock.seconds() - job.queued_time) if job.queued_time is not None else 0.0
+        lane_stats = self._lane_stats[job.lane]
+        lane_stats["started"] += 1
+        lane_stats["total_wait"] += wait
+        lane_stats["max_wait"] = max(lane_stats["max_wait"], wait)
+        lane_stats["last_wait"] = wait
+
+    def resume(self):
+        """Start queued jobs after the next stage is accepting work again"""
+        self._run_queued()
+
+    def _run_queued(self):
+        """Start queued jobs while there are free slots"""
+        while self._running < self.concurrentMax:
+            if self.accepting_func is not None and not self.accepting_func():
+                break
+            job = self._pop_next()
+            if job is None:
+                break
+            self._run(job)
+
+    def _run(self, job):
+        """Run function in separate thread, or in the reactor thread if the job is not in_thread"""
         self._running += 1
-        deferred = threads.deferToThread(f, *args, **kwargs)
-        deferred.addBoth(self._try_queued)
-        return deferred
+        self._running_per_host[job.host] = self._running_per_host.get(job.host, 0) + 1
+        # Added last, so the waiters get the result after the job callbacks have been run
+        job.deferred.addBoth(job.notify_waiters)
+        if job.in_thread:
+            deferred = threads.deferToThread(job.f, *job.args, **job.kwargs)
+        else:
+            deferred = defer.maybeDeferred(job.f, *job.args, **job.kwargs)
+        deferred.addBoth(self._job_finished, job)
+        deferred.chainDeferred(job.deferred)
 
-    def _try_queued(self, r):
-        """Execute next job in queue if it exists"""
+    def _job_finished(self, r, job):
+        """Execute next jobs in queue if they exist"""
         self._running -= 1
-        if self._running < self.concurrentMax and self._queued:
-            f, args, kwargs, d = self._queued.pop(0)
-            new_d = self._run(f, args, kwargs)
-            new_d.chainDeferred(d)
-        if isinstance(r, Failure):
-            r.trap()
+        self._running_per_host[job.host] -= 1
+        if self._running_per_host[job.host] == 0:
+            del self._running_per_host[job.host]
+        self._run_queued()
+        for f in self.on_job_finished:
+            f()
         return r
+
+
+class RSSFeedPipelineStage(object):
+    """A stage of the RSS Feed update pipeline.
+
+    The items put into the stage are passed to f by at most workers jobs at the
+    same time, in separate threads if in_thread is True, else in the reactor thread.
+    The stage is not accepting more items when max_queued items are waiting, and the
+    functions in on_space are called when it is accepting items again.
+    """
+    def __init__(self, name, f, workers=1, max_queued=None, in_thread=True, logger=None):
+        self.name = name
+        self.f = f
+        self.workers = workers
+        self.max_queued = max_queued
+        self.in_thread = in_thread
+        self.log = logger
+        self.on_space = []
+        self.processed = 0
+        self._running = 0
+        self._queued = deque()
+
+    def set_limits(self, workers, max_queued=None):
+        self.workers = workers
+        self.max_queued = max_queued
+        self._run_queued()
+
+    def put(self, item):
+        """Put item into the stage queue.
+        Returns a deferred which fires with the result of f(item)
+        """
+        d = defer.Deferred()
+        self._queued.append((item, d))
+        self._run_queued()
+        return d
+
+    def queued_count(self):
+        return len(self._queued)
+
+    def is_accepting(self):
+        # No limit when max_queued is None or 0
+        return not self.max_queued or len(self._queued) < self.max_queued
+
+    def get_stats(self):
+        return {"queued": len(self._queued), "running": self._running, "processed": self.processed}
+
+    def _run_queued(self):
+        was_accepting = self.is_accepting()
+        while self._running < self.workers and self._queued:
+            item, d = self._queued.popleft()
+            self._run(item, d)
+        if not was_accepting and self.is_accepting():
+            for f in self.on_space:
+                f()
+
+    def _run(self, item, d):
+        self._running += 1
+        if self.in_thread:
+            deferred = threads.deferToThread(self.f, item)
+        else:
+            deferred = defer.maybeDeferred(self.f, item)
+        deferred.addBoth(self._finished)
+        deferred.chainDeferred(d)
+
+    def _finished(self, result):
+        self._running -= 1
+        self.processed += 1
+        self._run_queued()
+        return result
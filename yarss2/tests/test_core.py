@@ -250,9 +250,21 @@ class RPCServerTestCase(BaseTestCase, TestCaseDebug):
         }
         args.append(rssfeed_data)
 
+        # The RSS Feed is fetched by the run queue, so keep the deferred to wait for the response
+        queued = []
+        queue_rssfeed_parsed = self.core.rssfeed_scheduler.queue_rssfeed_parsed
+
+        def queue_rssfeed_parsed_wrapper(*args, **kwargs):
+            d = queue_rssfeed_parsed(*args, **kwargs)
+            queued.append(d)
+            return d
+        self.core.rssfeed_scheduler.queue_rssfeed_parsed = queue_rssfeed_parsed_wrapper
+
         # Makes a call to core.get_rssfeed_parsed
         self.protocol.dispatch(self.request_id, method, args, {})
+        return queued[0].addCallback(self.verify_core_get_rssfeed_parsed_response)
 
+    def verify_core_get_rssfeed_parsed_response(self, result):
         msg_bytes = self.protocol.transport.messages_written[0]
 
         self.protocol.transport.dataReceived(msg_bytes)
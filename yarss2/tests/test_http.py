@@ -7,11 +7,65 @@
 # See LICENSE for more details.
 #
 
+import gzip
+import threading
+import time
+import zlib
+from io import BytesIO
+
+from twisted.internet import defer
 from twisted.trial import unittest
 
 import yarss2.yarss_config
 from yarss2.util import common, http
 
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+
+class FeedRequestHandler(BaseHTTPRequestHandler):
+    """Serves a small feed with an ETag, keeping the connections alive"""
+    protocol_version = "HTTP/1.1"
+    body = b"<rss version='2.0'><channel><title>Feed</title></channel></rss>"
+    etag = '"feed-etag"'
+
+    def do_GET(self):  # NOQA
+        self.server.client_ports.append(self.client_address[1])
+        self.server.cookies.append(self.headers.get("Cookie"))
+        self.server.accept_encodings.append(self.headers.get("Accept-Encoding"))
+        if self.path in self.server.files:
+            self.send_chunked(*self.server.files[self.path])
+            return
+        if self.headers.get("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", self.etag)
+        self.send_header("Set-Cookie", "session=secret")
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def send_chunked(self, body, content_encoding=None, chunk_size=8192):
+        """Send body without a Content-Length, like a feed generated on the fly"""
+        self.send_response(200)
+        self.send_header("Transfer-Encoding", "chunked")
+        if content_encoding:
+            self.send_header("Content-Encoding", content_encoding)
+        self.end_headers()
+        for i in range(0, len(body), chunk_size):
+            chunk = body[i:i + chunk_size]
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, format, *args):
+        pass
+
 
 class HTTPTestCase(unittest.TestCase):
 
@@ -64,6 +118,20 @@ class HTTPTestCase(unittest.TestCase):
         result = http.url_fix(url)
         self.assertEquals(expected, result)
 
+    def test_get_retry_after(self):
+        self.assertEquals(http.get_retry_after({}), None)
+        self.assertEquals(http.get_retry_after({"retry-after": "120"}), 120)
+        self.assertEquals(http.get_retry_after({"retry-after": "invalid"}), None)
+        # Wed, 21 Oct 2015 07:28:00 GMT
+        self.assertEquals(http.get_retry_after({"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"},
+                                               now=1445412480 - 60), 60)
+
+    def test_is_rate_limit_page(self):
+        filename = common.get_resource("rarbg.to.rss.too_many_requests.html", path="tests/data/feeds/")
+        with open(filename, "rb") as f:
+            self.assertTrue(http.is_rate_limit_page(f.read()))
+        self.assertFalse(http.is_rate_limit_page(b"<rss></rss>"))
+
     @unittest.SkipTest
     def test_feedparser_ampersant_in_url(self):
         """A bug in feedparser resulted in URL containing &amp when XML Parser was not available.
@@ -117,3 +185,207 @@ class HTTPTestCase(unittest.TestCase):
         self.assertEquals('The top100 torrents', parsed_feeds.description)
         self.assertEquals('https://therss.so', parsed_feeds.link)
         self.assertEquals(None, parsed_feeds.ttl)
+
+    def start_feed_server(self):
+        from yarss2 import load_libs
+        load_libs()
+        server = HTTPServer(("127.0.0.1", 0), FeedRequestHandler)
+        server.client_ports = []
+        server.cookies = []
+        server.files = {}
+        server.accept_encodings = []
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.addCleanup(http.close_session)
+        return server, "http://127.0.0.1:%d/rss" % server.server_address[1]
+
+    def test_download_file_session(self):
+        server, url = self.start_feed_server()
+        result = http.download_file(url, timeout=5)
+        self.assertEquals(result["status"], 200)
+        self.assertEquals(result["etag"], FeedRequestHandler.etag)
+        self.assertTrue(result["content"].endswith(FeedRequestHandler.body))
+
+        result = http.download_file(url, etag=result["etag"], timeout=5)
+        self.assertEquals(result["status"], 304)
+        self.assertFalse(FeedRequestHandler.body in result["content"])
+
+        # The connection is kept alive and reused for the next request
+        self.assertEquals(len(server.client_ports), 2)
+        self.assertEquals(server.client_ports[0], server.client_ports[1])
+        # The cookies set by the site are not stored in the shared session
+        self.assertEquals(server.cookies, [None, None])
+
+    def test_get_session(self):
+        from yarss2 import load_libs
+        load_libs()
+        self.addCleanup(http.set_session_pool_limits, http.DEFAULT_SESSION_POOL_HOSTS,
+                        http.DEFAULT_SESSION_POOL_MAXSIZE)
+        session = http.get_session()
+        self.assertTrue(session is http.get_session())
+        http.set_session_pool_limits(http.DEFAULT_SESSION_POOL_HOSTS, http.DEFAULT_SESSION_POOL_MAXSIZE)
+        self.assertTrue(session is http.get_session())
+        http.set_session_pool_limits(http.DEFAULT_SESSION_POOL_HOSTS, 8)
+        session = http.get_session()
+        self.assertEquals(session.get_adapter("https://example.com")._pool_maxsize, 8)
+        http.close_session()
+        self.assertFalse(session is http.get_session())
+
+    def read_feed_file(self, filename):
+        with open(common.get_resource(filename, path="tests/data/feeds/"), "rb") as f:
+            return f.read()
+
+    def test_parse_rss_stream(self):
+        import atoma
+        from yarss2 import rssfeed_handling
+        atoma.rss.supported_rss_versions = []
+        for filename in ["freebsd_rss.xml", "ezrss-rss-1.xml", "showrss.xml", "rss_with_special_dates.rss"]:
+            data = self.read_feed_file(filename)
+            expected = rssfeed_handling.atoma_result_to_dict(atoma.parse_rss_bytes(data))
+            parsed = rssfeed_handling.atoma_result_to_dict(rssfeed_handling.parse_rss_stream(BytesIO(data)))
+            self.assertEquals(parsed, expected)
+
+    def test_fetch_and_parse_rssfeed_streaming(self):
+        from yarss2 import rssfeed_handling
+        server, url = self.start_feed_server()
+        data = self.read_feed_file("freebsd_rss.xml")
+        server.files["/freebsd_rss.xml"] = (data,)
+        feed_url = url.replace("/rss", "/freebsd_rss.xml")
+
+        parsed_feed = rssfeed_handling.fetch_and_parse_rssfeed_atom(feed_url, timeout=5)
+        self.assertEquals(len(parsed_feed["items"]), 25)
+        self.assertEquals(parsed_feed["fetch_stats"]["bytes"], len(data))
+        self.assertEquals(parsed_feed["fetch_stats"]["status"], 200)
+
+        # The download is aborted when the feed is too large
+        self.assertRaises(http.FeedTooLargeError, rssfeed_handling.fetch_and_parse_rssfeed_atom,
+                          feed_url, timeout=5, max_size=len(data) // 2)
+        # The Content-Length is checked before downloading the body
+        self.assertRaises(http.FeedTooLargeError, http.open_feed_stream, url, timeout=5, max_size=10)
+
+    def test_fetch_and_parse_rssfeed_streaming_error_page(self):
+        from yarss2 import rssfeed_handling
+        server, url = self.start_feed_server()
+        server.files["/error.html"] = (self.read_feed_file("rarbg.to.rss.too_many_requests.html"),)
+        parsed_feed = rssfeed_handling.fetch_and_parse_rssfeed_atom(url.replace("/rss", "/error.html"), timeout=5)
+        self.assertEquals(parsed_feed["bozo"], 1)
+        self.assertTrue(parsed_feed["fetch_stats"]["rate_limited"])
+
+    def test_fetch_and_parse_rssfeed_compressed(self):
+        from yarss2 import rssfeed_handling
+        server, url = self.start_feed_server()
+        data = self.read_feed_file("freebsd_rss.xml")
+        raw_deflate = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        server.files["/gzip"] = (gzip.compress(data), "gzip")
+        server.files["/deflate"] = (zlib.compress(data), "deflate")
+        server.files["/raw_deflate"] = (raw_deflate.compress(data) + raw_deflate.flush(), "deflate")
+
+        for path in ["/gzip", "/deflate", "/raw_deflate"]:
+            parsed_feed = rssfeed_handling.fetch_and_parse_rssfeed_atom(url.replace("/rss", path), timeout=5)
+            self.assertEquals(len(parsed_feed["items"]), 25)
+            self.assertEquals(parsed_feed["fetch_stats"]["bytes"], len(data))
+            self.assertEquals(parsed_feed["fetch_stats"]["compressed_bytes"], len(server.files[path][0]))
+            self.assertEquals(parsed_feed["fetch_stats"]["content_encoding"], server.files[path][1])
+        self.assertEquals(server.accept_encodings[-1], http.get_accept_encoding())
+
+    def test_get_content_decoder(self):
+        data = b"<rss>" * 100000
+        decoder = http.get_content_decoder("gzip")
+        # Compression bombs are not inflated past max_length
+        self.assertEquals(len(decoder.decompress(gzip.compress(data), 1000)), 1000)
+
+        decoder = http.get_content_decoder("deflate, gzip")
+        self.assertEquals(decoder.decompress(gzip.compress(zlib.compress(data))) + decoder.flush(), data)
+        self.assertEquals(http.get_content_decoder("identity").decompress(data), data)
+
+        if http.brotli is None:
+            self.assertFalse("br" in http.get_accept_encoding())
+        else:
+            decoder = http.get_content_decoder("br")
+            self.assertEquals(decoder.decompress(http.brotli.compress(data)) + decoder.flush(), data)
+        if http.zstandard is None:
+            self.assertFalse("zstd" in http.get_accept_encoding())
+        else:
+            decoder = http.get_content_decoder("zstd")
+            compressed = http.zstandard.ZstdCompressor().compress(data)
+            self.assertEquals(decoder.decompress(compressed) + decoder.flush(), data)
+
+    def test_open_feed_stream_deadline(self):
+        server, url = self.start_feed_server()
+        server.files["/freebsd_rss.xml"] = (self.read_feed_file("freebsd_rss.xml"),)
+        feed_url = url.replace("/rss", "/freebsd_rss.xml")
+        self.assertRaises(http.DeadlineExceededError, http.open_feed_stream, feed_url, timeout=(5, 5),
+                          deadline=time.monotonic() - 1)
+
+        stream = http.open_feed_stream(feed_url, timeout=(5, 5), deadline=time.monotonic() + 60)
+        self.assertTrue(stream.read(1024))
+        # The download is aborted when it is still running at the deadline
+        stream.deadline = time.monotonic() - 1
+        self.assertRaises(http.DeadlineExceededError, stream.read, 1024)
+        stream.close()
+
+    def start_twisted_http_client(self):
+        from yarss2.util.twisted_http import TwistedHTTPClient
+        client = TwistedHTTPClient()
+        # Close the kept alive connections before the server is shut down
+        self.addCleanup(client.close)
+        return client
+
+    @defer.inlineCallbacks
+    def test_twisted_http_client(self):
+        server, url = self.start_feed_server()
+        client = self.start_twisted_http_client()
+        result = yield client.get(url, timeout=(5, 5))
+        self.assertEquals(result["status"], 200)
+        self.assertEquals(result["etag"], FeedRequestHandler.etag)
+        self.assertEquals(result["content"], FeedRequestHandler.body)
+
+        result = yield client.get(url, headers={"If-None-Match": result["etag"], "Cookie": "key=value"},
+                                  timeout=(5, 5))
+        self.assertEquals(result["status"], 304)
+        self.assertEquals(result["content"], b"")
+        # The connection is kept alive and reused for the next request
+        self.assertEquals(server.client_ports[0], server.client_ports[1])
+        self.assertEquals(server.cookies, [None, "key=value"])
+        self.assertEquals(server.accept_encodings[-1], http.get_accept_encoding())
+
+        data = self.read_feed_file("freebsd_rss.xml")
+        server.files["/gzip"] = (gzip.compress(data), "gzip")
+        result = yield client.get(url.replace("/rss", "/gzip"), timeout=(5, 5))
+        self.assertEquals(result["content"], data)
+        self.assertEquals(result["compressed_bytes"], len(server.files["/gzip"][0]))
+
+        # The download is aborted when the body is too large
+        yield self.assertFailure(client.get(url.replace("/rss", "/gzip"), timeout=(5, 5), max_size=len(data) // 2),
+                                 http.FeedTooLargeError)
+        yield self.assertFailure(client.get(url, timeout=(5, 5), max_size=10), http.FeedTooLargeError)
+        self.assertRaises(http.DeadlineExceededError, client.get, url, timeout=(5, 5),
+                          deadline=time.monotonic() - 1)
+
+    @defer.inlineCallbacks
+    def test_fetch_and_parse_rssfeed_prefetched(self):
+        from yarss2 import rssfeed_handling
+        server, url = self.start_feed_server()
+        client = self.start_twisted_http_client()
+        data = self.read_feed_file("freebsd_rss.xml")
+        server.files["/freebsd_rss.xml"] = (gzip.compress(data), "gzip")
+        result = yield client.get(url.replace("/rss", "/freebsd_rss.xml"), timeout=(5, 5))
+
+        parsed_feed = rssfeed_handling.fetch_and_parse_rssfeed_atom("http://unused", prefetched=result)
+        self.assertEquals(len(parsed_feed["items"]), 25)
+        self.assertEquals(parsed_feed["fetch_stats"]["bytes"], len(data))
+        self.assertEquals(parsed_feed["fetch_stats"]["compressed_bytes"], len(server.files["/freebsd_rss.xml"][0]))
+        self.assertEquals(parsed_feed["fetch_stats"]["fetch_duration"], result["fetch_duration"])
+        # A failed download is raised
+        self.assertRaises(http.FeedTooLargeError, rssfeed_handling.fetch_and_parse_rssfeed_atom,
+                          "http://unused", prefetched=http.FeedTooLargeError())
+
+    def test_get_deadline_timeout(self):
+        self.assertEquals(http.get_deadline_timeout((5, 30), None), (5, 30))
+        connect_timeout, read_timeout = http.get_deadline_timeout((5, 30), time.monotonic() + 10)
+        self.assertEquals(connect_timeout, 5)
+        self.assertTrue(9 < read_timeout <= 10)
+        self.assertEquals(http.get_socket_timeout((5, 30)), 30)
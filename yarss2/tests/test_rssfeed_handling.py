@@ -10,7 +10,7 @@ import datetime
 
 import yarss2.util.common
 from yarss2 import rssfeed_handling
-from yarss2.util import common, logging
+from yarss2.util import common, http, logging
 
 from . import common as test_common
 from .base import TestCaseDebug
@@ -291,6 +291,56 @@ class RSSFeedHandlingTestCase(TestCaseDebug):
         matches = matche_result["matching_torrents"]
         self.assertTrue(len(matches) == 3)
 
+    def test_fetch_feed_torrents_not_modified(self):
+        download_file = http.download_file
+        sent_validators = []
+
+        def download_file_with_etag(url, etag=None, modified=None, **kwargs):
+            sent_validators.append((etag, modified))
+            if etag == "etag-1":
+                return {"status": 304, "content": b"", "headers": {}, "etag": etag}
+            result = download_file(url, etag=etag, modified=modified, **kwargs)
+            result["etag"] = "etag-1"
+            return result
+
+        http.download_file = download_file_with_etag
+        try:
+            self._test_fetch_feed_torrents_not_modified(sent_validators)
+        finally:
+            http.download_file = download_file
+
+    def _test_fetch_feed_torrents_not_modified(self, sent_validators):
+        config = test_common.get_test_config_dict()
+
+        fetch_result = self.rssfeedhandler.fetch_feed_torrents(config, "0")
+        self.assertEquals(len(fetch_result["matching_torrents"]), 3)
+        self.assertEquals(self.rssfeedhandler.get_http_validators("0", config["rssfeeds"]["0"]["url"]),
+                          ("etag-1", None))
+
+        # The feed has not changed, so nothing is parsed or matched
+        fetch_result = self.rssfeedhandler.fetch_feed_torrents(config, "0")
+        self.assertTrue(fetch_result["not_modified"])
+        self.assertEquals(fetch_result["matching_torrents"], [])
+        self.assertEquals(fetch_result["rssfeed_items"], None)
+        self.assertEquals(fetch_result["fetch_stats"]["status"], 304)
+
+        # Subscriptions run manually do not send the validators
+        fetch_result = self.rssfeedhandler.fetch_feed_torrents(config, None, subscription_key="0")
+        self.assertEquals(len(fetch_result["matching_torrents"]), 3)
+
+        self.rssfeedhandler.clear_http_validators("0")
+        fetch_result = self.rssfeedhandler.fetch_feed_torrents(config, "0")
+        self.assertEquals(len(fetch_result["matching_torrents"]), 3)
+        self.assertEquals(sent_validators, [(None, None), ("etag-1", None), (None, None), (None, None)])
+
+    def test_get_http_validators_changed_url(self):
+        self.rssfeedhandler.set_http_validators("0", "http://example.com/rss", "etag", "modified")
+        self.assertEquals(self.rssfeedhandler.get_http_validators("0", "http://example.com/rss"),
+                          ("etag", "modified"))
+        self.assertEquals(self.rssfeedhandler.get_http_validators("0", "http://example.com/rss2"), (None, None))
+        self.rssfeedhandler.set_http_validators("0", "http://example.com/rss", None, None)
+        self.assertEquals(self.rssfeedhandler.get_http_validators("0", "http://example.com/rss"), (None, None))
+
     def test_fetch_feed_torrents_custom_user_agent(self):
         config = test_common.get_test_config_dict()
         custom_user_agent = "TEST AGENT"
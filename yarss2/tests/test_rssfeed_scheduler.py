@@ -9,12 +9,15 @@
 
 import threading
 
+from twisted.internet import task
 from twisted.internet.defer import Deferred, DeferredList
 from twisted.trial import unittest
 
 import yarss2.util.common
 import yarss2.yarss_config
-from yarss2.rssfeed_scheduler import RSSFeedRunQueue, RSSFeedScheduler
+from yarss2.rssfeed_scheduler import (RUN_LANE_INTERACTIVE, RUN_LANE_TIMER, RSSFeedCircuitBreaker, RSSFeedMetrics,
+                                      RSSFeedPipelineStage, RSSFeedPollStats, RSSFeedRunJob, RSSFeedRunQueue,
+                                      RSSFeedScheduler)
 from yarss2.util import logging
 
 from . import common as test_common
@@ -38,34 +41,41 @@ class RSSFeedSchedulerTestCase(unittest.TestCase):
         self.config.set_config({"rssfeeds": self.rssfeeds,
                                 "email_configurations": {"send_email_on_torrent_events": False}})
 
-        self.scheduler = RSSFeedScheduler(self.config, log)
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.scheduler = RSSFeedScheduler(self.config, log, clock=self.clock)
         test_component = TestComponent()
         self.scheduler.torrent_handler.download_torrent_file = test_component.download_torrent_file
+        self.scheduled_at = self.clock.seconds()
         self.scheduler.enable_timers()
 
     def tearDown(self):  # NOQA
-        # Must stop loopingcalls or test fails
         self.scheduler.disable_timers()
 
+    def assert_next_update(self, key, interval, scheduled_at):
+        timer = self.scheduler.rssfeed_timers[key]
+        self.assertEquals(interval, timer["update_interval"])
+        jitter = interval * 60 * yarss2.yarss_config.DEFAULT_UPDATE_JITTER_PERCENT / 100.0
+        self.assertTrue(scheduled_at + interval * 60 <= timer["next_update"])
+        self.assertTrue(timer["next_update"] <= self.scheduler.clock.seconds() + interval * 60 + jitter)
+
     def test_enable_timers(self):
         # Now verify the timers
+        self.assertEquals(len(self.scheduler.rssfeed_timers.keys()), 5)
         for key in self.scheduler.rssfeed_timers.keys():
-            # Is the timer running?
-            self.assertTrue(self.scheduler.rssfeed_timers[key]["timer"].running)
-
             # Does the timer have the correct interval?
-            interval = self.scheduler.rssfeed_timers[key]["timer"].interval
-            self.assertEquals(self.rssfeeds[key]["update_interval"] * 60, interval)
-            self.assertEquals(self.rssfeeds[key]["update_interval"],
-                              self.scheduler.rssfeed_timers[key]["update_interval"])
+            self.assert_next_update(key, self.rssfeeds[key]["update_interval"], self.scheduled_at)
+
+        # The delayed call is scheduled for the timer that is due first
+        self.assertTrue(self.scheduler._timer_call.active())
+        self.assertEquals(self.scheduler._timer_call_time, self.scheduler.rssfeed_timers["0"]["next_update"])
 
     def test_disable_timers(self):
         self.scheduler.disable_timers()
 
         # Now verify that the timers have been stopped
-        for key in self.scheduler.rssfeed_timers.keys():
-            # Is the timer running?
-            self.assertFalse(self.scheduler.rssfeed_timers[key]["timer"].running)
+        self.assertEquals(len(self.scheduler.rssfeed_timers.keys()), 0)
+        self.assertEquals(self.scheduler._timer_call, None)
 
     def test_delete_timer(self):
         # Delete timer
@@ -77,24 +87,63 @@ class RSSFeedSchedulerTestCase(unittest.TestCase):
 
     def test_reschedule_timer(self):
         # Change interval to 60 minutes
+        scheduled_at = self.scheduler.clock.seconds()
         self.assertTrue(self.scheduler.set_timer("0", 60))
-
-        interval = self.scheduler.rssfeed_timers["0"]["timer"].interval
-        self.assertEquals(60 * 60, interval)
-        self.assertEquals(self.scheduler.rssfeed_timers["0"]["update_interval"], 60)
+        self.assert_next_update("0", 60, scheduled_at)
+        # The delayed call is now scheduled for the timer with key "1"
+        self.assertEquals(self.scheduler._timer_call_time, self.scheduler.rssfeed_timers["1"]["next_update"])
 
     def test_schedule_timer(self):
         # Add new timer (with key "5") with interval 60 minutes
+        scheduled_at = self.scheduler.clock.seconds()
         self.assertTrue(self.scheduler.set_timer("5", 60))
 
         # Verify timer values
-        interval = self.scheduler.rssfeed_timers["5"]["timer"].interval
-        self.assertEquals(60 * 60, interval)
-        self.assertEquals(self.scheduler.rssfeed_timers["5"]["update_interval"], 60)
+        self.assert_next_update("5", 60, scheduled_at)
 
         # Should now be 6 timers
         self.assertEquals(len(self.scheduler.rssfeed_timers.keys()), 6)
 
+    def test_timers_queue_updates_when_due(self):
+        queued = []
+
+        def queue_rssfeed_update(rssfeed_key=None, subscription_key=None):
+            queued.append(rssfeed_key)
+        self.scheduler.queue_rssfeed_update = queue_rssfeed_update
+
+        # Feed "0" has interval 1 minute, and feed "1" has interval 3 minutes
+        self.clock.advance(65)
+        self.assertEquals(queued, ["0"])
+        self.assert_next_update("0", 1, self.scheduled_at + 60)
+        self.clock.advance(65)
+        self.clock.advance(65)
+        self.assertEquals(queued, ["0", "0", "1", "0"])
+
+        # Deleted timers are not run
+        self.scheduler.delete_timer("0")
+        self.clock.advance(120)
+        self.assertEquals(queued, ["0", "0", "1", "0"])
+
+    def test_timers_update_on_startup(self):
+        self.scheduler.disable_timers()
+        for key in self.rssfeeds:
+            self.rssfeeds[key]["update_on_startup"] = True
+        self.config.set_config({"rssfeeds": self.rssfeeds})
+
+        queued = []
+
+        def queue_rssfeed_update(rssfeed_key=None, subscription_key=None):
+            queued.append(rssfeed_key)
+        self.scheduler.queue_rssfeed_update = queue_rssfeed_update
+        self.scheduler.enable_timers()
+
+        # The startup updates are spread over the startup window
+        for key in self.rssfeeds:
+            next_update = self.scheduler.rssfeed_timers[key]["next_update"]
+            self.assertTrue(next_update <= self.clock.seconds() + yarss2.yarss_config.DEFAULT_STARTUP_UPDATE_WINDOW)
+        self.clock.advance(yarss2.yarss_config.DEFAULT_STARTUP_UPDATE_WINDOW)
+        self.assertEquals(sorted(queued), sorted(self.rssfeeds.keys()))
+
     def test_rssfeed_update_handler(self):
         subscription = yarss2.yarss_config.get_fresh_subscription_config(rssfeed_key="0", key="0")
         self.config.set_config({"subscriptions": {"0": subscription}})
@@ -124,6 +173,56 @@ class RSSFeedSchedulerTestCase(unittest.TestCase):
         # Safe function should not raise exception
         self.assertFalse(self.scheduler.rssfeed_update_handler_safe(1))
 
+    def test_rssfeed_update_metrics(self):
+        self.scheduler.disable_timers()
+        self.config.set_config(test_common.get_test_config_dict())
+
+        self.scheduler.rssfeed_update_handler("0")
+        self.scheduler.rssfeed_update_handler(subscription_key="0")
+        # Fails with KeyError
+        self.scheduler.rssfeed_update_handler_safe("5")
+
+        metrics = self.scheduler.metrics.get_metrics()
+        history = metrics["0"]["history"]
+        self.assertEquals(len(history), 2)
+        self.assertEquals([record["manual"] for record in history], [False, True])
+        for record in history:
+            self.assertTrue(record["fetch_duration"] >= 0)
+            self.assertTrue(record["parse_duration"] >= 0)
+            self.assertTrue(record["match_duration"] >= 0)
+            self.assertTrue(record["bytes"] > 0)
+            self.assertEquals(record["items"], 25)
+            self.assertEquals(record["error"], None)
+        self.assertEquals(metrics["0"]["summary"]["updates"], 2)
+        self.assertEquals(metrics["0"]["summary"]["errors"], 0)
+
+        self.assertEquals(metrics["5"]["summary"]["errors"], 1)
+        self.assertEquals(metrics["5"]["summary"]["error_rate"], 1.0)
+        self.assertTrue("KeyError" in metrics["5"]["summary"]["last_error"])
+
+    def test_circuit_breaker_rate_limited(self):
+        self.scheduler.disable_timers()
+        config = test_common.get_test_config_dict()
+        config["rssfeeds"]["0"]["url"] = yarss2.util.common.get_resource(
+            "rarbg.to.rss.too_many_requests.html", path="tests/data/feeds/")
+        self.config.set_config(config)
+        self.scheduler.enable_timers()
+
+        self.scheduler.rssfeed_update_handler("0")
+        self.assertTrue(self.scheduler.is_circuit_open("0"))
+        self.assertTrue(self.scheduler.is_circuit_open(subscription_key="0"))
+        self.assertFalse(self.scheduler.is_circuit_open("2"))
+
+        # Timer updates are skipped
+        self.scheduler.queue_rssfeed_update("0")
+        stats = self.scheduler.get_run_queue_stats()
+        self.assertEquals(stats["circuit_open_skips"], 1)
+        self.assertEquals(stats["circuit_breakers"]["rssfeeds"]["0"]["failures"], 1)
+        self.assertEquals(stats["lanes"][RUN_LANE_TIMER]["started"], 0)
+
+        self.clock.advance(yarss2.yarss_config.DEFAULT_CIRCUIT_BREAKER_BASE_DELAY)
+        self.assertFalse(self.scheduler.is_circuit_open("0"))
+
     def test_ttl_value_updated(self):
         config = test_common.get_test_config_dict()
         config["rssfeeds"]["0"]["update_interval"] = 30
@@ -150,13 +249,47 @@ class RSSFeedSchedulerTestCase(unittest.TestCase):
 
         # Verify that update_interval of the timer was updated
         self.assertEquals(self.scheduler.rssfeed_timers["0"]["update_interval"], 60)
+        self.assertTrue(self.scheduler.rssfeed_timers["0"]["next_update"] >= self.clock.seconds() + 60 * 60)
+        self.scheduler.disable_timers()
+
+    def test_adaptive_interval(self):
+        config = test_common.get_test_config_dict()
+        config["rssfeeds"]["0"]["update_interval"] = 30
+        config["rssfeeds"]["0"]["adaptive_interval"] = True
+
         self.scheduler.disable_timers()
+        self.config.set_config(config)
+        self.scheduler.enable_timers()
+
+        def add_torrents_pass(*arg):
+            pass
+        self.scheduler.add_torrents_func = add_torrents_pass
+
+        # The first fetch has nothing to compare with
+        self.scheduler.rssfeed_update_handler("0")
+        self.assertEquals(self.scheduler.rssfeed_timers["0"]["update_interval"], 30)
+
+        # No new items, so the interval is doubled
+        self.clock.advance(30 * 60)
+        self.scheduler.rssfeed_update_handler("0")
+        self.assertEquals(self.scheduler.rssfeed_timers["0"]["update_interval"], 60)
+
+        stats = self.scheduler.get_poll_stats()["0"]
+        self.assertEquals(stats["fetches"], 2)
+        self.assertEquals(stats["last_new_items"], 0)
+        self.assertEquals(stats["update_interval"], 60)
+        # The interval in the config is not changed
+        self.assertEquals(self.config.get_config()["rssfeeds"]["0"]["update_interval"], 30)
+
+        # Manually running a subscription does not count in the stats
+        self.scheduler.rssfeed_update_handler(subscription_key="0")
+        self.assertEquals(self.scheduler.get_poll_stats()["0"]["fetches"], 2)
 
     def test_rssfeed_update_queue(self):
         """Tests that the add_torrents_func is called the correct number of times,
         and that add_torrents_func is running in the main thread.
         """
-        # Don't use the loopingcall, so disable just to avoid any trouble
+        # Don't use the timers, so disable just to avoid any trouble
         self.scheduler.disable_timers()
         self.config.set_config(test_common.get_test_config_dict())
 
@@ -178,6 +311,189 @@ class RSSFeedSchedulerTestCase(unittest.TestCase):
             self.assertEquals(len(add_torrents_count), 3)
         return DeferredList([d_first, d_last]).addBoth(verify_callback_count)
 
+    def test_rssfeed_update_queue_merge_duplicates(self):
+        """Tests that updates of the same RSS Feed waiting in the queue are merged,
+        and that each caller gets the result of the shared update"""
+        self.scheduler.disable_timers()
+        self.config.set_config(test_common.get_test_config_dict())
+
+        add_torrents_count = []
+
+        def add_torrents_cb(*arg):
+            add_torrents_count.append(0)
+        self.scheduler.add_torrents_func = add_torrents_cb
+
+        # The first update is started immediately, the second is queued
+        # and the third is merged with the second
+        deferreds = [self.scheduler.queue_rssfeed_update(rssfeed_key="0") for i in range(3)]
+        self.assertEquals(self.scheduler.run_queue.queued_count(), 1)
+
+        def verify_callback_count(results):
+            self.assertEquals([success for (success, result) in results], [True] * 3)
+            self.assertEquals(len(add_torrents_count), 2)
+        return DeferredList(deferreds).addCallback(verify_callback_count)
+
+    def set_overload_policy(self, policy):
+        self.scheduler.disable_timers()
+        self.config.get_config()["general"]["max_queued_updates"] = 1
+        self.config.get_config()["general"]["overload_policy"] = policy
+        self.scheduler.enable_timers()
+        # Do not start any jobs
+        self.scheduler.run_queue.set_limits(0)
+
+    def test_overload_skip(self):
+        self.set_overload_policy("skip")
+        self.scheduler.queue_rssfeed_update("0")
+        self.scheduler.queue_rssfeed_update("1")
+        # Merged with the queued update, so not an overload
+        self.scheduler.queue_rssfeed_update("0")
+        # Updates started by the user are not limited
+        self.scheduler.queue_rssfeed_update("1", lane=RUN_LANE_INTERACTIVE)
+
+        stats = self.scheduler.get_run_queue_stats()
+        self.assertEquals(stats["overload_events"], {"skip": 1, "coalesce": 0, "delay": 0})
+        self.assertEquals(stats["lanes"][RUN_LANE_TIMER]["queued"], 1)
+        self.assertEquals(stats["lanes"][RUN_LANE_INTERACTIVE]["queued"], 1)
+
+    def test_overload_delay(self):
+        self.set_overload_policy("delay")
+        self.scheduler.queue_rssfeed_update("0")
+        self.scheduler.queue_rssfeed_update("4")
+
+        self.assertEquals(self.scheduler.get_run_queue_stats()["overload_events"]["delay"], 1)
+        self.assertEquals(self.scheduler.rssfeed_timers["4"]["next_update"],
+                          self.clock.seconds() + yarss2.yarss_config.DEFAULT_OVERLOAD_DELAY)
+
+    def test_overload_coalesce(self):
+        self.set_overload_policy("coalesce")
+
+        def add_torrents_pass(*arg):
+            pass
+        self.scheduler.add_torrents_func = add_torrents_pass
+
+        deferreds = []
+        queue_rssfeed_update = self.scheduler.queue_rssfeed_update
+
+        def queue_rssfeed_update_wrapper(*args, **kwargs):
+            d = queue_rssfeed_update(*args, **kwargs)
+            deferreds.append(d)
+            return d
+        self.scheduler.queue_rssfeed_update = queue_rssfeed_update_wrapper
+
+        for key in ["0", "1", "2", "1"]:
+            self.scheduler.queue_rssfeed_update(key)
+        stats = self.scheduler.get_run_queue_stats()
+        self.assertEquals(stats["overload_events"]["coalesce"], 3)
+        self.assertEquals(stats["coalesced_updates"], 2)
+
+        # The coalesced updates are queued when the queued update has been run
+        self.scheduler.run_queue.set_limits(1)
+
+        def verify(result):
+            self.assertEquals(len(deferreds), 6)
+            self.assertEquals(self.scheduler.get_run_queue_stats()["coalesced_updates"], 0)
+            self.assertEquals(self.scheduler.get_run_queue_stats()["lanes"][RUN_LANE_TIMER]["started"], 3)
+        return deferreds[0].addCallback(lambda r: DeferredList(deferreds[4:])).addCallback(verify)
+
+
+class RSSFeedCircuitBreakerTestCase(unittest.TestCase):
+
+    def test_exponential_backoff(self):
+        clock = task.Clock()
+        breaker = RSSFeedCircuitBreaker(clock, threshold=2, base_delay=10, max_delay=30)
+        self.assertEquals(breaker.record_failure("0"), None)
+        self.assertFalse(breaker.is_open("0"))
+        self.assertEquals([breaker.record_failure("0") for i in range(4)], [10, 20, 30, 30])
+        self.assertTrue(breaker.is_open("0"))
+        self.assertEquals(breaker.get_stats()["0"], {"failures": 5, "opened": 4, "closes_in": 30})
+        clock.advance(30)
+        self.assertFalse(breaker.is_open("0"))
+
+        breaker.record_success("0")
+        self.assertEquals(breaker.get_failures("0"), 0)
+        self.assertEquals(breaker.get_stats(), {})
+
+    def test_rate_limited(self):
+        clock = task.Clock()
+        breaker = RSSFeedCircuitBreaker(clock, threshold=3, base_delay=10, max_delay=30)
+        # Opened at once, and Retry-After is respected even if longer than max_delay
+        self.assertEquals(breaker.record_failure("host", rate_limited=True), 10)
+        self.assertEquals(breaker.record_failure("host", retry_after=3600, rate_limited=True), 3600)
+        clock.advance(3599)
+        self.assertTrue(breaker.is_open("host"))
+
+
+class RSSFeedMetricsTestCase(unittest.TestCase):
+
+    def test_history_size(self):
+        metrics = RSSFeedMetrics(history_size=3)
+        fetch_result = {"fetch_stats": {"fetch_duration": 1.0, "parse_duration": 0.5, "bytes": 100, "status": 200},
+                        "match_duration": 0.1, "rssfeed_items": {0: {}, 1: {}}, "matching_torrents": [{}]}
+        for i in range(5):
+            metrics.record_update("0", fetch_result, 2.0)
+        metrics.record_error("0", "Failed", 3.0)
+        # Not fetched, so not recorded
+        metrics.record_update("0", {"rssfeed_items": None, "matching_torrents": []}, 0.0)
+
+        feed_metrics = metrics.get_metrics("0")["0"]
+        self.assertEquals(len(feed_metrics["history"]), 3)
+        self.assertEquals(feed_metrics["summary"]["errors"], 1)
+        self.assertEquals(feed_metrics["summary"]["bytes"], 200)
+        self.assertEquals(feed_metrics["summary"]["matches"], 2)
+        self.assertEquals(feed_metrics["summary"]["max_fetch_duration"], 1.0)
+        self.assertEquals(feed_metrics["summary"]["average_duration"], 7.0 / 3)
+        self.assertEquals(feed_metrics["summary"]["last_error"], "Failed")
+
+        metrics.set_history_size(1)
+        self.assertEquals(len(metrics.get_metrics()["0"]["history"]), 1)
+        self.assertEquals(metrics.get_metrics("1"), {})
+
+
+class RSSFeedPollStatsTestCase(unittest.TestCase):
+
+    def get_items(self, ids):
+        return dict((i, {"link": "http://site/%d" % i, "title": str(i)}) for i in ids)
+
+    def test_record_fetch(self):
+        poll_stats = RSSFeedPollStats()
+        self.assertEquals(poll_stats.record_fetch("0", None, 0), None)
+        self.assertEquals(poll_stats.record_fetch("0", self.get_items(range(10)), 0), None)
+
+        stats = poll_stats.record_fetch("0", self.get_items(range(2, 12)), 3600)
+        self.assertEquals(stats["fetches"], 2)
+        self.assertEquals(stats["last_new_items"], 2)
+        self.assertEquals(stats["new_items_per_hour"], 2)
+
+        stats = poll_stats.record_fetch("0", self.get_items(range(2, 12)), 7200)
+        self.assertEquals(stats["new_items"], 2)
+        self.assertEquals(stats["last_new_items"], 0)
+        self.assertAlmostEqual(stats["new_items_per_fetch"], 1.4)
+
+        poll_stats.delete("0")
+        self.assertEquals(poll_stats.get_stats(), {})
+
+    def test_record_fetch_not_modified(self):
+        poll_stats = RSSFeedPollStats()
+        # Nothing to compare with
+        self.assertEquals(poll_stats.record_fetch("0", None, 0, not_modified=True), None)
+        poll_stats.record_fetch("0", self.get_items(range(10)), 0)
+        stats = poll_stats.record_fetch("0", None, 3600, not_modified=True)
+        self.assertEquals(stats["fetches"], 2)
+        self.assertEquals(stats["last_new_items"], 0)
+        stats = poll_stats.record_fetch("0", self.get_items(range(1, 11)), 7200)
+        self.assertEquals(stats["last_new_items"], 1)
+
+    def test_get_adaptive_interval(self):
+        poll_stats = RSSFeedPollStats()
+        # 2 new items per hour gives one new item every 30 minutes
+        self.assertEquals(poll_stats.get_adaptive_interval({"new_items_per_hour": 2}, 20, 5, 360), 30)
+        # The interval is changed by at most a factor of two
+        self.assertEquals(poll_stats.get_adaptive_interval({"new_items_per_hour": 0}, 20, 5, 360), 40)
+        self.assertEquals(poll_stats.get_adaptive_interval({"new_items_per_hour": 60}, 20, 5, 360), 10)
+        # Within the bounds
+        self.assertEquals(poll_stats.get_adaptive_interval({"new_items_per_hour": 60}, 8, 5, 360), 5)
+        self.assertEquals(poll_stats.get_adaptive_interval({"new_items_per_hour": 0}, 300, 5, 360), 360)
+
 
 class RSSFeedRunQueueTestCase(unittest.TestCase):
 
@@ -231,3 +547,182 @@ class RSSFeedRunQueueTestCase(unittest.TestCase):
         # Add verify_callback_results to the deferred chain
         d_verify.chainDeferred(d_verify_callback)
         return d_verify
+
+    def test_task_queue_per_host_limit(self):
+        """Test that jobs on different hosts run concurrently, while
+        jobs on the same host never exceed the per host limit"""
+        lock = threading.Lock()
+        running = {}
+        max_running = {}
+        host_b_started = threading.Event()
+
+        def test_run(host, wait_for_b):
+            with lock:
+                running[host] = running.get(host, 0) + 1
+                max_running[host] = max(max_running.get(host, 0), running[host])
+            if host == "b":
+                host_b_started.set()
+            started = host_b_started.wait(5) if wait_for_b else True
+            with lock:
+                running[host] -= 1
+            return started
+
+        taskq = RSSFeedRunQueue(concurrent_max=2, concurrent_max_per_host=1)
+        deferreds = [taskq.push_job(RSSFeedRunJob(test_run, args=("a", True), host="a")),
+                     taskq.push_job(RSSFeedRunJob(test_run, args=("a", False), host="a")),
+                     taskq.push_job(RSSFeedRunJob(test_run, args=("b", False), host="b"))]
+        # Only one job per host can run, so the second job on host "a" must be queued
+        self.assertEquals(taskq.queued_count(), 1)
+
+        def verify(results):
+            # The first job on host "a" must have seen the job on host "b" start
+            self.assertTrue(results[0][1])
+            self.assertEquals(max_running, {"a": 1, "b": 1})
+        return DeferredList(deferreds).addCallback(verify)
+
+    def test_task_queue_host_fairness(self):
+        """Test that queued jobs are started in turn for each host"""
+        run_order = []
+
+        def test_run(job_id):
+            return job_id
+
+        taskq = RSSFeedRunQueue(concurrent_max=1)
+        deferreds = []
+        for job_id, host in [("a1", "a"), ("a2", "a"), ("a3", "a"), ("b1", "b"), ("c1", "c")]:
+            d = taskq.push_job(RSSFeedRunJob(test_run, args=(job_id,), host=host))
+            d.addCallback(run_order.append)
+            deferreds.append(d)
+
+        def verify(args):
+            self.assertEquals(run_order, ["a1", "b1", "c1", "a2", "a3"])
+        return DeferredList(deferreds).addCallback(verify)
+
+    def test_task_queue_merge_jobs(self):
+        """Test that queued jobs with the same key are merged, and that
+        all callers get the result of the job"""
+        run_count = []
+
+        def test_run(job_id):
+            run_count.append(job_id)
+            return job_id
+
+        def job_callback(result):
+            return "%s done" % result
+
+        taskq = RSSFeedRunQueue(concurrent_max=1)
+        deferreds = []
+        for job_id in ["a", "b", "b", "b"]:
+            job = RSSFeedRunJob(test_run, args=(job_id,), key=job_id)
+            job.deferred.addCallback(job_callback)
+            deferreds.append(taskq.push_job(job))
+        self.assertEquals(taskq.queued_count(), 1)
+
+        def verify(results):
+            self.assertEquals(run_count, ["a", "b"])
+            self.assertEquals([result for (success, result) in results],
+                              ["a done", "b done", "b done", "b done"])
+        return DeferredList(deferreds).addCallback(verify)
+
+    def test_task_queue_lanes(self):
+        """Test that interactive jobs are started before the queued timer jobs,
+        and that a queued timer job merged with an interactive job is moved to the interactive lane"""
+        run_order = []
+        clock = task.Clock()
+
+        def test_run(job_id):
+            return job_id
+
+        taskq = RSSFeedRunQueue(concurrent_max=1, clock=clock)
+        deferreds = []
+        for job_id, lane in [("t1", RUN_LANE_TIMER), ("t2", RUN_LANE_TIMER), ("t3", RUN_LANE_TIMER),
+                             ("i1", RUN_LANE_INTERACTIVE), ("t3", RUN_LANE_INTERACTIVE)]:
+            d = taskq.push_job(RSSFeedRunJob(test_run, args=(job_id,), key=job_id, lane=lane))
+            d.addCallback(run_order.append)
+            deferreds.append(d)
+            clock.advance(10)
+
+        stats = taskq.get_lane_stats()
+        self.assertEquals(stats[RUN_LANE_INTERACTIVE]["queued"], 2)
+        self.assertEquals(stats[RUN_LANE_TIMER]["queued"], 1)
+        self.assertEquals(stats[RUN_LANE_TIMER]["oldest_queued_wait"], 40)
+
+        def verify(args):
+            self.assertEquals(run_order, ["t1", "i1", "t3", "t3", "t2"])
+            stats = taskq.get_lane_stats()
+            self.assertEquals(stats[RUN_LANE_INTERACTIVE]["started"], 2)
+            self.assertEquals(stats[RUN_LANE_INTERACTIVE]["max_wait"], 30)
+            self.assertEquals(stats[RUN_LANE_TIMER]["started"], 2)
+            self.assertEquals(stats[RUN_LANE_TIMER]["last_wait"], 40)
+            self.assertEquals(stats[RUN_LANE_TIMER]["queued"], 0)
+        return DeferredList(deferreds).addCallback(verify)
+
+    def test_task_queue_paused_by_next_stage(self):
+        """Test that queued jobs are not started while the next stage is not accepting work"""
+        accepting = [False]
+        run_order = []
+
+        def test_run(job_id):
+            return job_id
+
+        taskq = RSSFeedRunQueue(concurrent_max=2)
+        taskq.accepting_func = lambda: accepting[0]
+        deferreds = []
+        for job_id in ["a", "b"]:
+            d = taskq.push_job(RSSFeedRunJob(test_run, args=(job_id,)))
+            d.addCallback(run_order.append)
+            deferreds.append(d)
+        self.assertEquals(taskq.queued_count(), 2)
+
+        accepting[0] = True
+        taskq.resume()
+        self.assertEquals(taskq.queued_count(), 0)
+
+        def verify(args):
+            self.assertEquals(sorted(run_order), ["a", "b"])
+        return DeferredList(deferreds).addCallback(verify)
+
+
+class RSSFeedPipelineStageTestCase(unittest.TestCase):
+
+    def test_stage_workers_and_queue_limit(self):
+        """Test that at most workers items are processed at the same time,
+        and that on_space is called when the stage is accepting items again"""
+        running = []
+        max_running = []
+        lock = threading.Lock()
+        space_count = []
+        release = threading.Event()
+
+        def process(item):
+            with lock:
+                running.append(item)
+                max_running.append(len(running))
+            release.wait(5)
+            with lock:
+                running.remove(item)
+            return item * 2
+
+        stage = RSSFeedPipelineStage("Test", process, workers=2, max_queued=2)
+        stage.on_space.append(lambda: space_count.append(0))
+        deferreds = [stage.put(i) for i in range(4)]
+        self.assertEquals(stage.queued_count(), 2)
+        self.assertFalse(stage.is_accepting())
+        release.set()
+
+        def verify(results):
+            self.assertEquals([result for (success, result) in results], [0, 2, 4, 6])
+            self.assertTrue(max(max_running) <= 2)
+            self.assertEquals(len(space_count), 1)
+            self.assertEquals(stage.get_stats(), {"queued": 0, "running": 0, "processed": 4})
+        return DeferredList(deferreds).addCallback(verify)
+
+    def test_stage_in_reactor_thread(self):
+        main_thread = threading.current_thread()
+
+        def process(item):
+            self.assertEquals(main_thread, threading.current_thread())
+            return item
+
+        stage = RSSFeedPipelineStage("Test", process, in_thread=False)
+        return stage.put("item").addCallback(self.assertEquals, "item")
@@ -9,6 +9,8 @@
 
 import datetime
 import os.path
+import threading
+import time
 from unittest import mock
 
 import requests
@@ -54,7 +56,7 @@ class TestComponent(object):
         self.added.append(download)
         return download
 
-    def download_torrent_file(self, torrent_url, cookies=None, headers=None):
+    def download_torrent_file(self, torrent_url, cookies=None, headers=None, timeout=None, deadline=None):
         download = TorrentDownload()
         download.torrent_url = torrent_url
         download.cookies = cookies
@@ -85,11 +87,21 @@ def get(key):
 yarss2.torrent_handling.component = test_torrent_handling
 
 
-def get_file(url, cookies={}, headers={}, verify=True):
+def get_file(url, cookies={}, headers={}, verify=True, timeout=None, stream=False):
 
     class Request(object):
-        pass
-    r = Request
+        content = None
+
+        def iter_content(self, chunk_size):
+            if self.content is not None:
+                yield self.content
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+    r = Request()
     try:
         r.content = read_file(url)
     except Exception:
@@ -97,12 +109,14 @@ def get_file(url, cookies={}, headers={}, verify=True):
     return r
 
 
-requests.get = get_file
+def session_get(session, url, **kwargs):
+    return get_file(url, **kwargs)
 
 
 class TorrentHandlingTestCase(unittest.TestCase):
 
     def setUp(self):  # NOQA
+        self.patch(requests.Session, "get", session_get)
         self.log = log
         self.config = test_common.get_test_config()
         # get_test_config will load a new core.conf with the default values.
@@ -193,6 +207,104 @@ class TorrentHandlingTestCase(unittest.TestCase):
         self.assertEquals(download.cookies, {'cookiekey': 'cookievalue'})
         self.assertFalse(download.is_magnet)
 
+    def test_get_torrents_ordered_and_host_limited(self):
+        handler = TorrentHandler(self.log)
+        lock = threading.Lock()
+        running = {}
+        max_running = {}
+
+        def download_torrent_file(torrent_url, cookies=None, headers=None, timeout=None, deadline=None):
+            host = torrent_url.split("/")[2]
+            with lock:
+                running[host] = running.get(host, 0) + 1
+                max_running[host] = max(max_running.get(host, 0), running[host])
+            # Let the downloads overlap
+            time.sleep(0.05)
+            with lock:
+                running[host] -= 1
+            download = TorrentDownload()
+            download.torrent_url = torrent_url
+            download.success = False
+            return download
+        handler.download_torrent_file = download_torrent_file
+
+        torrent_list = [{"link": "http://site%d.com/%d.torrent" % (i % 2, i)} for i in range(10)]
+        torrent_list.insert(3, {"link": "magnet:hash"})
+        downloads = handler.get_torrents(torrent_list, max_workers=6, max_per_host=2)
+
+        self.assertEquals(len(downloads), len(torrent_list))
+        self.assertTrue(downloads[3].is_magnet)
+        del downloads[3]
+        del torrent_list[3]
+        self.assertEquals([d.torrent_url for d in downloads], [t["link"] for t in torrent_list])
+        self.assertEquals(max(max_running.values()), 2)
+
+    def test_get_torrents_timeouts(self):
+        handler = TorrentHandler(self.log)
+        requested = []
+
+        def download_torrent_file(torrent_url, cookies=None, headers=None, timeout=None, deadline=None):
+            requested.append((timeout, deadline))
+            return TorrentDownload()
+        handler.download_torrent_file = download_torrent_file
+
+        start_time = time.monotonic()
+        handler.get_torrents([{"link": "http://site.com/1.torrent", "timeout": (5, 15), "update_deadline": 60}])
+        self.assertEquals(requested[0][0], (5, 15))
+        self.assertTrue(start_time + 60 <= requested[0][1] <= time.monotonic() + 60)
+
+    def test_get_torrents_async(self):
+        from twisted.internet import defer
+        handler = TorrentHandler(self.log)
+        filename = yarss2.util.common.get_resource("FreeBSD-9.0-RELEASE-amd64-dvd1.torrent", path="tests/data/")
+        running = {}
+        max_running = {}
+        requested = []
+
+        class Client(object):
+            def get(self, url, headers=None, timeout=None, deadline=None, verify=True):
+                host = url.split("/")[2]
+                requested.append((url, headers, timeout, verify))
+                running[host] = running.get(host, 0) + 1
+                max_running[host] = max(max_running.get(host, 0), running[host])
+                d = defer.Deferred()
+
+                def finish():
+                    running[host] -= 1
+                    if url.endswith("0.torrent"):
+                        d.errback(IOError("Connection refused"))
+                    else:
+                        d.callback({"content": read_file(filename)})
+                from twisted.internet import reactor
+                reactor.callLater(0.01, finish)
+                return d
+
+        torrent_list = [{"link": "http://site%d.com/%d.torrent" % (i % 2, i), "user_agent": "test",
+                         "site_cookies_dict": {"key": "value"}, "timeout": (5, 15)} for i in range(6)]
+        torrent_list.insert(3, {"link": "magnet:hash"})
+
+        def check(downloads):
+            self.assertEquals(len(downloads), len(torrent_list))
+            self.assertTrue(downloads[3].is_magnet)
+            self.assertFalse(downloads[0].success)
+            self.assertTrue(all(download.success for download in downloads[1:]))
+            self.assertEquals([d.url for d in downloads], [t["link"] for t in torrent_list])
+            self.assertEquals(max(max_running.values()), 2)
+            self.assertEquals(requested[1][1], {"User-Agent": "test", "Cookie": "key=value"})
+            self.assertEquals(requested[1][2:], ((5, 15), False))
+
+        d = handler.get_torrents_async(torrent_list, Client(), max_workers=6, max_per_host=2)
+        d.addCallback(check)
+        return d
+
+    def test_download_torrent_file_deadline_passed(self):
+        handler = TorrentHandler(self.log)
+        filename = yarss2.util.common.get_resource("FreeBSD-9.0-RELEASE-amd64-dvd1.torrent", path="tests/data/")
+        download = handler.download_torrent_file(filename, deadline=time.monotonic() - 1)
+        self.assertFalse(download.success)
+        download = handler.download_torrent_file(filename, deadline=time.monotonic() + 60)
+        self.assertTrue(download.success)
+
     def test_get_torrent_magnet(self):
         handler = TorrentHandler(self.log)
         torrent_info = {"link": "magnet:hash"}
@@ -27,6 +27,14 @@ class ConfigTestCase(unittest.TestCase):
     def setUp(self):  # NOQA
         self.config = test_common.get_test_config(verify_config=False)
 
+    def test_get_rssfeed_timeouts(self):
+        rssfeed = yarss2.yarss_config.get_fresh_rssfeed_config(read_timeout=60)
+        self.assertEquals(yarss2.yarss_config.get_rssfeed_timeouts(rssfeed),
+                          ((yarss2.yarss_config.DEFAULT_CONNECT_TIMEOUT, 60),
+                           yarss2.yarss_config.DEFAULT_UPDATE_DEADLINE))
+        general_config = {"connect_timeout": 5, "read_timeout": 20, "update_deadline": 300}
+        self.assertEquals(yarss2.yarss_config.get_rssfeed_timeouts(rssfeed, general_config), ((5, 60), 300))
+
     def test_insert_missing_dict_values(self):
         default_subscription = yarss2.yarss_config.get_fresh_subscription_config()
         subscription_del = yarss2.yarss_config.get_fresh_subscription_config()
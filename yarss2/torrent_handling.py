@@ -8,28 +8,43 @@
 #
 
 import os
-
-import requests
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import deluge.component as component
 from deluge._libtorrent import lt
 from deluge.core.torrent import TorrentOptions
 from deluge.error import AddTorrentError
+from twisted.internet import defer
 
 from yarss2.util import common, http, torrentinfo
 from yarss2.util.common import GeneralSubsConf, TorrentDownload
 from yarss2.util.yarss_email import send_torrent_email
+from yarss2.yarss_config import (DEFAULT_CONNECT_TIMEOUT, DEFAULT_MAX_TORRENT_DOWNLOADS_PER_HOST, DEFAULT_READ_TIMEOUT,
+                                 DEFAULT_TORRENT_DOWNLOAD_WORKERS)
 
 
 class TorrentHandler(object):
 
     def __init__(self, logger):
         self.log = logger
+        # Semaphores limiting the concurrent torrent downloads for each host
+        self._host_semaphores = {}
+        self._host_semaphores_limit = None
+        self._host_semaphores_lock = threading.Lock()
+        # The same for the downloads in the reactor thread (get_torrents_async)
+        self._deferred_host_semaphores = {}
+        self._deferred_host_semaphores_limit = None
 
     def listen_on_torrent_finished(self, enable=True):
         component.get("EventManager").register_event_handler("TorrentFinishedEvent", self.on_torrent_finished_event)
 
-    def download_torrent_file(self, torrent_url, cookies=None, headers=None):
+    def download_torrent_file(self, torrent_url, cookies=None, headers=None,
+                              timeout=(DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT), deadline=None):
+        """Download the torrent file at torrent_url. The download fails if the site does not
+        answer within timeout (connect timeout, read timeout), or if it is still running
+        at deadline (a time.monotonic() value)."""
         download = TorrentDownload()
         download.url = torrent_url
         download.cookies = cookies
@@ -40,16 +55,21 @@ class TorrentHandler(object):
             args["headers"] = headers
         download.headers = headers
         try:
-            r = requests.get(torrent_url, **args)
-            download.filedump = r.content
+            r = http.get_session().get(torrent_url, timeout=http.get_deadline_timeout(timeout, deadline),
+                                       stream=True, **args)
+            with r:
+                download.filedump = http.read_body(r, deadline=deadline)
         except Exception as e:
             error_msg = "Failed to download torrent url: '%s'. Exception: %s" % (torrent_url, str(e))
             self.log.error(error_msg)
             download.set_error(error_msg)
             return download
+        return self._check_torrent_file(download)
 
-        if download.filedump is None:
-            error_msg = "Filedump is None"
+    def _check_torrent_file(self, download):
+        """Sets the error of the download if the downloaded file is not a valid torrent file"""
+        if not download.filedump:
+            error_msg = "Filedump is empty"
             download.set_error(error_msg)
             self.log.warning(error_msg)
             return download
@@ -58,12 +78,21 @@ class TorrentHandler(object):
             # Get the info to see if any exceptions are raised
             lt.torrent_info(lt.bdecode(download.filedump))
         except Exception as e:
-            error_msg = "Unable to decode torrent file! (%s) URL: '%s'" % (str(e), torrent_url)
+            error_msg = "Unable to decode torrent file! (%s) URL: '%s'" % (str(e), download.url)
             download.set_error(error_msg)
             self.log.error(error_msg)
         return download
 
-    def get_torrent(self, torrent_info):
+    def _open_torrent_info(self, download):
+        """Get the torrent data from the torrent file, setting the error of the download on failure"""
+        try:
+            torrentinfo.TorrentInfo(filedump=download.filedump)
+        except Exception as e:
+            download.set_error("Unable to open torrent file: %s. Error: %s" % (download.url, str(e)))
+            self.log.warning(download.error_msg)
+        return download
+
+    def get_torrent(self, torrent_info, deadline=None):
         url = torrent_info["link"]
         site_cookies_dict = torrent_info.get("site_cookies_dict", None)
         download = None
@@ -81,18 +110,123 @@ class TorrentHandler(object):
             url = http.url_fix(url)
             self.log.info("Downloading torrent: '%s' using cookies: '%s', headers: '%s'" %
                           (url, str(site_cookies_dict), str(headers)), gtkui=True)
-            download = self.download_torrent_file(url, cookies=site_cookies_dict, headers=headers)
+            download = self.download_torrent_file(url, cookies=site_cookies_dict, headers=headers,
+                                                  timeout=torrent_info.get("timeout", None) or
+                                                  (DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT),
+                                                  deadline=deadline)
             # Error occured
             if not download.success:
                 return download
-            # Get the torrent data from the torrent file
-            try:
-                torrentinfo.TorrentInfo(filedump=download.filedump)
-            except Exception as e:
-                download.set_error("Unable to open torrent file: %s. Error: %s" % (url, str(e)))
-                self.log.warning(download.error_msg)
+            self._open_torrent_info(download)
         return download
 
+    def get_torrents(self, torrent_list, max_workers=DEFAULT_TORRENT_DOWNLOAD_WORKERS,
+                     max_per_host=DEFAULT_MAX_TORRENT_DOWNLOADS_PER_HOST):
+        """Get the torrents in torrent_list, with at most max_workers downloads at the same time,
+        and at most max_per_host downloads from the same host (also counting other batches).
+        Returns the TorrentDownload objects in the same order as torrent_list.
+
+        The downloads must be done within the update_deadline of each torrent, counted from now.
+        """
+        start_time = time.monotonic()
+
+        def get_torrent(torrent_info):
+            update_deadline = torrent_info.get("update_deadline", None)
+            deadline = start_time + update_deadline if update_deadline else None
+            return self._get_torrent_host_limited(torrent_info, max_per_host, deadline=deadline)
+
+        if max_workers <= 1 or len(torrent_list) <= 1:
+            return [get_torrent(torrent_info) for torrent_info in torrent_list]
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(torrent_list))) as executor:
+            # map returns the results in the order of torrent_list
+            return list(executor.map(get_torrent, torrent_list))
+
+    def get_torrents_async(self, torrent_list, client, max_workers=DEFAULT_TORRENT_DOWNLOAD_WORKERS,
+                           max_per_host=DEFAULT_MAX_TORRENT_DOWNLOADS_PER_HOST):
+        """Like get_torrents, but downloads the torrent files with client (a
+        yarss2.util.twisted_http.TwistedHTTPClient) in the reactor thread.
+        Returns a deferred firing with the TorrentDownload objects in the same order as torrent_list.
+        """
+        start_time = time.monotonic()
+        semaphore = defer.DeferredSemaphore(max(max_workers, 1))
+
+        def get_torrent(torrent_info):
+            url = torrent_info["link"]
+            if url.startswith("magnet:"):
+                return defer.succeed(self.get_torrent(torrent_info))
+            update_deadline = torrent_info.get("update_deadline", None)
+            deadline = start_time + update_deadline if update_deadline else None
+            if not max_per_host:
+                return semaphore.run(self._get_torrent_async, torrent_info, client, deadline)
+            # Waiting for the host does not take up a download slot
+            host_semaphore = self._get_deferred_host_semaphore(http.get_url_host(url), max_per_host)
+            return host_semaphore.run(semaphore.run, self._get_torrent_async, torrent_info, client, deadline)
+
+        return defer.gatherResults([get_torrent(torrent_info) for torrent_info in torrent_list], consumeErrors=True)
+
+    def _get_torrent_async(self, torrent_info, client, deadline=None):
+        download = TorrentDownload()
+        download.url = http.url_fix(torrent_info["link"])
+        download.cookies = torrent_info.get("site_cookies_dict", None)
+        download.headers = {}
+        if torrent_info.get("user_agent", None):
+            download.headers["User-Agent"] = torrent_info["user_agent"]
+        request_headers = dict(download.headers)
+        if download.cookies:
+            request_headers.update(http.get_cookie_header(download.cookies))
+        self.log.info("Downloading torrent: '%s' using cookies: '%s', headers: '%s'" %
+                      (download.url, str(download.cookies), str(download.headers)), gtkui=True)
+
+        def downloaded(result):
+            download.filedump = result["content"]
+            if self._check_torrent_file(download).success:
+                self._open_torrent_info(download)
+            return download
+
+        def failed(failure):
+            download.set_error("Failed to download torrent url: '%s'. Exception: %s" %
+                               (download.url, failure.getErrorMessage()))
+            self.log.error(download.error_msg)
+            return download
+
+        try:
+            d = client.get(download.url, headers=request_headers, verify=False, deadline=deadline,
+                           timeout=torrent_info.get("timeout", None) or (DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT))
+        except Exception:
+            d = defer.fail()
+        return d.addCallbacks(downloaded, failed)
+
+    def _get_deferred_host_semaphore(self, host, max_per_host):
+        if self._deferred_host_semaphores_limit != max_per_host:
+            self._deferred_host_semaphores = {}
+            self._deferred_host_semaphores_limit = max_per_host
+        if host not in self._deferred_host_semaphores:
+            self._deferred_host_semaphores[host] = defer.DeferredSemaphore(max_per_host)
+        return self._deferred_host_semaphores[host]
+
+    def _get_host_semaphore(self, host, max_per_host):
+        with self._host_semaphores_lock:
+            if self._host_semaphores_limit != max_per_host:
+                # Downloads holding the old semaphores finish with the old limit
+                self._host_semaphores = {}
+                self._host_semaphores_limit = max_per_host
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = threading.BoundedSemaphore(max_per_host)
+            return self._host_semaphores[host]
+
+    def _get_torrent_host_limited(self, torrent_info, max_per_host, deadline=None):
+        url = torrent_info["link"]
+        try:
+            if not max_per_host or url.startswith("magnet:"):
+                return self.get_torrent(torrent_info, deadline=deadline)
+            with self._get_host_semaphore(http.get_url_host(url), max_per_host):
+                return self.get_torrent(torrent_info, deadline=deadline)
+        except Exception as e:
+            download = TorrentDownload({"url": url})
+            download.set_error("Failed to get torrent: '%s'. Exception: %s" % (url, str(e)))
+            self.log.error(download.error_msg)
+            return download
+
     def add_torrent(self, torrent_info):
         # Initialize options with default configurations
         options = TorrentOptions()
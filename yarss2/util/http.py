@@ -8,6 +8,30 @@
 #
 
 import re
+import threading
+import time
+import zlib
+from email.utils import mktime_tz, parsedate_tz
+
+try:
+    from http.cookiejar import DefaultCookiePolicy
+except ImportError:
+    # python 2
+    from cookielib import DefaultCookiePolicy
+
+# Optional codecs, offered to the servers only when they are installed
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 PY2 = False
 PY3 = False
@@ -45,12 +69,405 @@ def download_file(url_file_stream_or_string, site_cookies_dict=None, etag=None,
             request_headers = {}
         request_headers.update(cookie_header)
 
-    data = feedparsing._open_resource(url_file_stream_or_string, etag, modified, user_agent, referrer,
-                                      handlers, request_headers, result, timeout=timeout)
+    if not handlers and is_http_url(url_file_stream_or_string):
+        data = _session_get_feed(url_file_stream_or_string, etag, modified, user_agent, referrer,
+                                 request_headers, result, timeout=timeout)
+    else:
+        data = feedparsing._open_resource(url_file_stream_or_string, etag, modified, user_agent, referrer,
+                                          handlers, request_headers, result, timeout=get_socket_timeout(timeout))
     result['content'] = feedparsing.convert_to_utf8(result['headers'], data, result)
     return result
 
 
+def _session_get_feed(url, etag, modified, user_agent, referrer, request_headers, result, timeout=None):
+    """Download the feed at url with the shared session, filling in result
+    like feedparsing.http.get does. Returns the (decompressed) content."""
+    response = _session_request_feed(url, etag, modified, user_agent, referrer, request_headers, result,
+                                     timeout=timeout)
+    return response.content
+
+
+def get_feed_request_headers(etag=None, modified=None, user_agent=None, referrer=None, request_headers=None):
+    """Returns the headers of a request for a feed, with the validators etag and modified"""
+    from .feedparsing import http as feedparsing_http
+    headers = {"User-Agent": user_agent or feedparsing_http.USER_AGENT,
+               "Accept": feedparsing_http.ACCEPT_HEADER,
+               "A-IM": "feed"}
+    if etag:
+        headers["If-None-Match"] = etag
+    if modified:
+        headers["If-Modified-Since"] = modified
+    if referrer:
+        headers["Referer"] = referrer
+    if request_headers:
+        headers.update(request_headers)
+    return headers
+
+
+def _session_request_feed(url, etag, modified, user_agent, referrer, request_headers, result,
+                          timeout=None, stream=False):
+    headers = get_feed_request_headers(etag, modified, user_agent, referrer, request_headers)
+    if stream:
+        # The streamed body is decoded by FeedStream, which also handles the optional codecs
+        headers["Accept-Encoding"] = get_accept_encoding()
+    if timeout == 'Global':
+        timeout = None
+
+    response = get_session().get(url, headers=headers, timeout=timeout, stream=stream)
+    # lowercase all of the HTTP headers for comparisons per RFC 2616
+    result['headers'] = dict((k.lower(), v) for k, v in response.headers.items())
+    if result['headers'].get('etag', None):
+        result['etag'] = result['headers']['etag']
+    if result['headers'].get('last-modified', None):
+        result['modified'] = result['headers']['last-modified']
+    result['href'] = response.url
+    result['status'] = response.status_code
+    return response
+
+
+def get_socket_timeout(timeout):
+    """Returns a single socket timeout for a requests timeout, which
+    may be a tuple of (connect timeout, read timeout)"""
+    if isinstance(timeout, tuple):
+        return max(timeout)
+    return timeout
+
+
+def get_deadline_timeout(timeout, deadline):
+    """Returns the requests timeout, with the read timeout shortened to the time
+    left until deadline (a time.monotonic() value). Raises DeadlineExceededError
+    if the deadline has passed."""
+    if deadline is None:
+        return timeout
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceededError("The deadline has passed")
+    if isinstance(timeout, tuple):
+        return (min(timeout[0], remaining), min(timeout[1], remaining))
+    return min(timeout, remaining) if timeout is not None else remaining
+
+
+class FeedTooLargeError(Exception):
+    """Raised when the body of a feed is larger than the maximum size"""
+
+
+class DeadlineExceededError(Exception):
+    """Raised when a download is still running at its deadline"""
+
+
+def open_feed_stream(url, etag=None, modified=None, user_agent=None, referrer=None, request_headers=None,
+                     timeout=None, max_size=None, deadline=None):
+    """Start downloading the feed at url with the shared session, and return a FeedStream
+    reading the (decompressed) body. The status and headers are in the result of the stream.
+    Raises FeedTooLargeError if the Content-Length is larger than max_size.
+    """
+    result = dict(bozo=False, headers={})
+    start_time = time.monotonic()
+    response = _session_request_feed(url, etag, modified, user_agent, referrer, request_headers, result,
+                                     timeout=get_deadline_timeout(timeout, deadline), stream=True)
+    stream = FeedStream(response, result, max_size=max_size, deadline=deadline)
+    stream.read_duration = time.monotonic() - start_time
+    content_length = result['headers'].get('content-length', "")
+    if max_size and content_length.isdigit() and int(content_length) > max_size:
+        stream.close()
+        raise FeedTooLargeError("The feed at '%s' is larger than the maximum size of %d bytes (Content-Length: %s)" %
+                                (url, max_size, content_length))
+    return stream
+
+
+def get_accept_encoding():
+    """Returns the content codings FeedStream can decode, for the Accept-Encoding header"""
+    encodings = ["gzip", "deflate"]
+    if brotli is not None:
+        encodings.append("br")
+    if zstandard is not None:
+        encodings.append("zstd")
+    return ", ".join(encodings)
+
+
+class _IdentityDecoder(object):
+
+    def decompress(self, data, max_length=0):
+        return data
+
+    def flush(self):
+        return b""
+
+
+class _ZlibDecoder(object):
+    """Decodes gzip, or deflate with or without the zlib header (both are sent as deflate).
+    The output of each call is limited to max_length bytes (if not 0), so a compression
+    bomb is never inflated past the maximum feed size."""
+
+    def __init__(self, wbits):
+        self._obj = zlib.decompressobj(wbits)
+        # Kept until the deflate data is known to have the zlib header
+        self._first_data = b"" if wbits == zlib.MAX_WBITS else None
+
+    def decompress(self, data, max_length=0):
+        if self._first_data is None:
+            return self._obj.decompress(data, max_length)
+        self._first_data += data
+        try:
+            decompressed = self._obj.decompress(data, max_length)
+        except zlib.error:
+            # Raw deflate data without the zlib header
+            self._obj = zlib.decompressobj(-zlib.MAX_WBITS)
+            data, self._first_data = self._first_data, None
+            return self._obj.decompress(data, max_length)
+        if decompressed:
+            self._first_data = None
+        return decompressed
+
+    def flush(self):
+        return self._obj.flush()
+
+
+class _BrotliDecoder(object):
+
+    def __init__(self):
+        self._obj = brotli.Decompressor()
+        # Brotli has process, brotlipy and brotlicffi have decompress
+        self._decompress = getattr(self._obj, "process", None) or self._obj.decompress
+
+    def decompress(self, data, max_length=0):
+        return self._decompress(data)
+
+    def flush(self):
+        return b""
+
+
+class _ZstdDecoder(object):
+
+    def __init__(self):
+        self._obj = zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data, max_length=0):
+        return self._obj.decompress(data)
+
+    def flush(self):
+        return b""
+
+
+class _MultiDecoder(object):
+    """Decodes several content codings, applied in the order they are listed"""
+
+    def __init__(self, decoders):
+        self._decoders = list(reversed(decoders))
+
+    def decompress(self, data, max_length=0):
+        for decoder in self._decoders:
+            data = decoder.decompress(data)
+        return data
+
+    def flush(self):
+        data = b""
+        for decoder in self._decoders:
+            data = decoder.decompress(data) + decoder.flush()
+        return data
+
+
+def get_content_decoder(content_encoding):
+    """Returns a decoder for the Content-Encoding header value, with the methods
+    decompress(data, max_length=0) and flush()"""
+    decoders = []
+    for encoding in (content_encoding or "").lower().split(","):
+        encoding = encoding.strip()
+        if encoding in ("gzip", "x-gzip"):
+            decoders.append(_ZlibDecoder(16 + zlib.MAX_WBITS))
+        elif encoding == "deflate":
+            decoders.append(_ZlibDecoder(zlib.MAX_WBITS))
+        elif encoding == "br" and brotli is not None:
+            decoders.append(_BrotliDecoder())
+        elif encoding == "zstd" and zstandard is not None:
+            decoders.append(_ZstdDecoder())
+    if not decoders:
+        return _IdentityDecoder()
+    if len(decoders) == 1:
+        return decoders[0]
+    return _MultiDecoder(decoders)
+
+
+class FeedStream(object):
+    """File like object returning the body of a streamed response in chunks as they arrive.
+    The body is decompressed chunk by chunk, so the compressed and the decompressed body
+    are never in memory.
+
+    Raises FeedTooLargeError when more than max_size (decompressed) bytes have been read,
+    and DeadlineExceededError when reading after deadline (a time.monotonic() value).
+    The first prefix_size bytes are kept, to show the error pages that are not feeds.
+    """
+    chunk_size = 16 * 1024
+    prefix_size = 64 * 1024
+
+    def __init__(self, response, result, max_size=None, deadline=None):
+        self.response = response
+        self.result = result
+        self.max_size = max_size
+        self.deadline = deadline
+        self.bytes_read = 0
+        self.compressed_bytes_read = 0
+        self.read_duration = 0.0
+        self.prefix = b""
+        self._decoder = get_content_decoder(result['headers'].get('content-encoding', ""))
+        self._chunks = response.raw.stream(self.chunk_size, decode_content=False)
+        self._tail = b""
+
+    def read(self, size=-1):
+        """Returns the next chunk of the body, or all of the rest of it if size is negative.
+        The chunks may be shorter or longer than size. Returns b"" at the end of the body."""
+        if size is None or size < 0:
+            return b"".join(iter(self._read_chunk, b""))
+        return self._read_chunk()
+
+    def _read_chunk(self):
+        start_time = time.monotonic()
+        if self.deadline is not None and start_time > self.deadline:
+            raise DeadlineExceededError("The download of the feed at '%s' did not finish before the deadline" %
+                                        self.response.url)
+        data = b""
+        while not data:
+            raw = next(self._chunks, None)
+            if raw is None:
+                data = self._decoder.flush()
+                break
+            self.compressed_bytes_read += len(raw)
+            # Decompress at most one byte more than allowed
+            max_length = self.max_size - self.bytes_read + 1 if self.max_size else 0
+            data = self._decoder.decompress(raw, max(max_length, 0))
+        self.read_duration += time.monotonic() - start_time
+        self.bytes_read += len(data)
+        if len(self.prefix) < self.prefix_size:
+            self.prefix += data[:self.prefix_size - len(self.prefix)]
+        if self.max_size and self.bytes_read > self.max_size:
+            raise FeedTooLargeError("The feed at '%s' is larger than the maximum size of %d bytes" %
+                                    (self.response.url, self.max_size))
+        return data
+
+    def close(self):
+        self.response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_body(response, deadline=None):
+    """Returns the body of a streamed response.
+    Raises DeadlineExceededError if it has not been read before deadline."""
+    chunks = []
+    for chunk in response.iter_content(FeedStream.chunk_size):
+        if deadline is not None and time.monotonic() > deadline:
+            raise DeadlineExceededError("The download of '%s' did not finish before the deadline" % response.url)
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def is_http_url(url):
+    return isinstance(url, str) and urlparse.urlsplit(url)[0].lower() in ("http", "https")
+
+
+# The connections to this many hosts are kept open for reuse
+DEFAULT_SESSION_POOL_HOSTS = 20
+# The number of connections to each host kept open for reuse
+DEFAULT_SESSION_POOL_MAXSIZE = 4
+
+_session = None
+_session_pool_limits = (DEFAULT_SESSION_POOL_HOSTS, DEFAULT_SESSION_POOL_MAXSIZE)
+_session_lock = threading.Lock()
+
+
+class _RejectCookiesPolicy(DefaultCookiePolicy):
+    """The cookies set by the sites must not be sent to the other RSS Feeds
+    sharing the session, so they are never stored."""
+
+    def set_ok(self, cookie, request):
+        return False
+
+
+def get_session():
+    """Returns the requests session shared by the RSS Feed and torrent downloads.
+    The connections are kept alive in a pool for each host, so the torrents downloaded
+    right after fetching a feed reuse the connection (and TLS session) of the feed.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = _new_session(*_session_pool_limits)
+        return _session
+
+
+def _new_session(pool_hosts, pool_maxsize):
+    import requests
+    session = requests.Session()
+    session.cookies.set_policy(_RejectCookiesPolicy())
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_maxsize)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def set_session_pool_limits(pool_hosts, pool_maxsize):
+    """Change the pool sizes of the shared session. The current session
+    is replaced on the next call to get_session if the limits have changed."""
+    global _session, _session_pool_limits
+    with _session_lock:
+        if _session_pool_limits == (pool_hosts, pool_maxsize):
+            return
+        _session_pool_limits = (pool_hosts, pool_maxsize)
+        # Requests still running on the old session finish before its connections are closed by the GC
+        _session = None
+
+
+def close_session():
+    """Close the connections of the shared session"""
+    global _session
+    with _session_lock:
+        session, _session = _session, None
+    if session is not None:
+        session.close()
+
+
+def get_url_host(url):
+    """Returns the lower case host name of url, or an empty string
+    if the url has no host (e.g. local files)"""
+    try:
+        host = urlparse.urlsplit(url).hostname
+    except ValueError:
+        return ""
+    return host if host else ""
+
+
+# HTTP status codes telling the client to slow down
+RATE_LIMIT_STATUS_CODES = (429, 503)
+# Some sites answer too many requests with an error page instead of a status code
+RATE_LIMIT_MESSAGE_REGEX = re.compile(br"too many requests", re.IGNORECASE)
+
+
+def get_retry_after(headers, now=None):
+    """Returns the number of seconds to wait according to the Retry-After
+    header (in seconds or as an HTTP date), or None if it is missing or invalid"""
+    value = headers.get("retry-after", None) if headers else None
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    if now is None:
+        now = time.time()
+    return max(0, int(mktime_tz(date) - now))
+
+
+def is_rate_limit_page(content):
+    """Returns True if content is an error page answering too many requests"""
+    return bool(content) and RATE_LIMIT_MESSAGE_REGEX.search(content[:4096]) is not None
+
+
 def get_matching_cookies_dict(cookies, url):
     """Takes a dictionary of cookie key/values, and
     returns a dict with the cookies matching the url
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012-2015 bendikro bro.devel+yarss2@gmail.com
+#
+# This file is part of YaRSS2 and is licensed under GNU General Public License 3.0, or later, with
+# the additional special exception to link portions of this program with the OpenSSL library.
+# See LICENSE for more details.
+#
+
+import time
+
+from twisted.internet import defer, protocol
+from twisted.internet.error import TimeoutError
+from twisted.web.client import (Agent, BrowserLikePolicyForHTTPS, HTTPConnectionPool, PotentialDataLoss,
+                                RedirectAgent, ResponseDone)
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import IPolicyForHTTPS
+from zope.interface import implementer
+
+from yarss2.util import http
+
+
+@implementer(IPolicyForHTTPS)
+class _NoVerifyPolicyForHTTPS(object):
+    """Does not verify the certificates, like verify=False with requests (used for the torrent files)"""
+
+    def creatorForNetloc(self, hostname, port):
+        from twisted.internet import ssl
+        return ssl.CertificateOptions(verify=False)
+
+
+class _BodyReceiver(protocol.Protocol):
+    """Receives the body of a response, decoding it as it arrives.
+
+    finished fires with the decoded body, or fails with http.FeedTooLargeError when it is
+    larger than max_size, with TimeoutError when no data is received for read_timeout
+    seconds, and with http.DeadlineExceededError if it is still running at deadline.
+    """
+
+    def __init__(self, finished, url, decoder, clock, max_size=None, read_timeout=None, deadline=None):
+        self.finished = finished
+        self.url = url
+        self.decoder = decoder
+        self.clock = clock
+        self.max_size = max_size
+        self.read_timeout = read_timeout
+        self.bytes_received = 0
+        self.compressed_bytes_received = 0
+        self._chunks = []
+        self._read_timer = None
+        self._deadline_timer = None
+        if deadline is not None:
+            self._deadline_timer = clock.callLater(
+                max(deadline - time.monotonic(), 0), self._abort,
+                http.DeadlineExceededError("The download of '%s' did not finish before the deadline" % url))
+
+    def connectionMade(self):  # NOQA
+        self._reset_read_timer()
+
+    def dataReceived(self, data):  # NOQA
+        if self.finished is None:
+            return
+        self.compressed_bytes_received += len(data)
+        # Decompress at most one byte more than allowed
+        max_length = self.max_size - self.bytes_received + 1 if self.max_size else 0
+        try:
+            data = self.decoder.decompress(data, max(max_length, 0))
+        except Exception as e:
+            self._abort(e)
+            return
+        self.bytes_received += len(data)
+        self._chunks.append(data)
+        if self.max_size and self.bytes_received > self.max_size:
+            self._abort(http.FeedTooLargeError("The body of '%s' is larger than the maximum size of %d bytes" %
+                                               (self.url, self.max_size)))
+            return
+        self._reset_read_timer()
+
+    def connectionLost(self, reason):  # NOQA
+        self._cancel_timers()
+        if self.finished is None:
+            return
+        finished, self.finished = self.finished, None
+        if not reason.check(ResponseDone, PotentialDataLoss):
+            finished.errback(reason)
+            return
+        try:
+            self._chunks.append(self.decoder.flush())
+        except Exception as e:
+            finished.errback(e)
+            return
+        finished.callback(b"".join(self._chunks))
+
+    def _reset_read_timer(self):
+        if self.read_timeout is None:
+            return
+        if self._read_timer is not None and self._read_timer.active():
+            self._read_timer.reset(self.read_timeout)
+        else:
+            self._read_timer = self.clock.callLater(
+                self.read_timeout, self._abort,
+                TimeoutError("No data received from '%s' for %s seconds" % (self.url, self.read_timeout)))
+
+    def _cancel_timers(self):
+        for timer in (self._read_timer, self._deadline_timer):
+            if timer is not None and timer.active():
+                timer.cancel()
+
+    def _abort(self, error):
+        self._cancel_timers()
+        if self.finished is None:
+            return
+        finished, self.finished = self.finished, None
+        self.transport.stopProducing()
+        finished.errback(error)
+
+
+class TwistedHTTPClient(object):
+    """Downloads feeds and torrent files with Twisted's non-blocking HTTP client in the
+    reactor thread, so waiting for the sites does not take up a thread for each download.
+
+    The connections are kept alive in a pool, with at most pool_maxsize idle connections
+    to each host. The bodies are decoded as they arrive, with the codings of http.get_accept_encoding.
+    """
+
+    def __init__(self, reactor=None, pool_maxsize=http.DEFAULT_SESSION_POOL_MAXSIZE):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = pool_maxsize
+        self._agents = {}
+
+    def set_pool_maxsize(self, pool_maxsize):
+        self.pool.maxPersistentPerHost = pool_maxsize
+
+    def _get_agent(self, connect_timeout, verify):
+        key = (connect_timeout, verify)
+        if key not in self._agents:
+            policy = BrowserLikePolicyForHTTPS() if verify else _NoVerifyPolicyForHTTPS()
+            self._agents[key] = RedirectAgent(Agent(self.reactor, contextFactory=policy,
+                                                    connectTimeout=connect_timeout, pool=self.pool))
+        return self._agents[key]
+
+    def get(self, url, headers=None, timeout=None, max_size=None, deadline=None, verify=True):
+        """GET url, following redirects.
+
+        timeout is a number or a tuple of (connect timeout, read timeout) in seconds,
+        max_size the maximum size of the (decoded) body, and deadline the time.monotonic()
+        value at which the download is aborted.
+
+        Returns a deferred firing with a dict with the status, the headers (lower case names),
+        href (the URL after redirects), etag, modified, the content, compressed_bytes
+        and fetch_duration, like the result of http.download_file.
+        """
+        start_time = time.monotonic()
+        timeout = http.get_deadline_timeout(timeout, deadline)
+        connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        request_headers = Headers()
+        request_headers.setRawHeaders(b"Accept-Encoding", [http.get_accept_encoding().encode("ascii")])
+        for name, value in (headers or {}).items():
+            request_headers.setRawHeaders(name.encode("latin-1"), [value.encode("utf-8")])
+
+        d = self._get_agent(connect_timeout, verify).request(b"GET", url.encode("utf-8"), request_headers)
+        # Waiting for the response headers counts as reading
+        timeout_call = None
+        if read_timeout is not None:
+            timeout_call = self.reactor.callLater(read_timeout, d.cancel)
+
+        def cancel_timeout(result):
+            if timeout_call is not None and timeout_call.active():
+                timeout_call.cancel()
+            return result
+
+        def read_response(response):
+            result = {"bozo": False, "status": response.code, "href": url}
+            if response.request is not None:
+                result["href"] = response.request.absoluteURI.decode("utf-8")
+            result["headers"] = dict((name.decode("latin-1").lower(), b", ".join(values).decode("latin-1"))
+                                     for name, values in response.headers.getAllRawHeaders())
+            if result["headers"].get("etag", None):
+                result["etag"] = result["headers"]["etag"]
+            if result["headers"].get("last-modified", None):
+                result["modified"] = result["headers"]["last-modified"]
+            content_length = result["headers"].get("content-length", "")
+            if max_size and content_length.isdigit() and int(content_length) > max_size:
+                response.deliverBody(protocol.Protocol())
+                raise http.FeedTooLargeError("The body of '%s' is larger than the maximum size of %d bytes "
+                                             "(Content-Length: %s)" % (url, max_size, content_length))
+            finished = defer.Deferred()
+            receiver = _BodyReceiver(finished, url, http.get_content_decoder(result["headers"].get("content-encoding")),
+                                     self.reactor, max_size=max_size, read_timeout=read_timeout, deadline=deadline)
+            response.deliverBody(receiver)
+
+            def body_received(content):
+                result["content"] = content
+                result["compressed_bytes"] = receiver.compressed_bytes_received
+                result["fetch_duration"] = time.monotonic() - start_time
+                return result
+            return finished.addCallback(body_received)
+
+        def convert_cancelled(failure):
+            failure.trap(defer.CancelledError)
+            raise TimeoutError("No response from '%s' within %s seconds" % (url, read_timeout))
+
+        d.addBoth(cancel_timeout)
+        d.addErrback(convert_cancelled)
+        d.addCallback(read_response)
+        return d
+
+    def close(self):
+        """Close the connections in the pool. Returns a deferred"""
+        return self.pool.closeCachedConnections()
@@ -26,6 +26,49 @@ except NameError:
 
 LATEST_CONFIG_VERSION = 8
 DEFAULT_UPDATE_INTERVAL = 120
+# How many RSS Feeds may be fetched at the same time, in total and for each site
+DEFAULT_MAX_CONCURRENT_FETCHES = 4
+DEFAULT_MAX_CONCURRENT_FETCHES_PER_HOST = 1
+# How many torrent downloads may run at the same time, and how many RSS Feed updates
+# may wait for the torrent downloads before no more RSS Feeds are fetched
+DEFAULT_MAX_CONCURRENT_DOWNLOADS = 2
+DEFAULT_MAX_QUEUED_DOWNLOADS = 10
+# How many updates started by the timers may wait in the run queue, and what to do with
+# the updates that are due when the queue is full (one of OVERLOAD_POLICIES)
+DEFAULT_MAX_QUEUED_UPDATES = 50
+OVERLOAD_POLICIES = ("skip", "coalesce", "delay")
+DEFAULT_OVERLOAD_POLICY = "coalesce"
+# Seconds to delay an RSS Feed with the "delay" overload policy
+DEFAULT_OVERLOAD_DELAY = 300
+# An RSS Feed (or host) is not updated by the timer for a while after this many failed updates in a row.
+# The delay starts at the base delay, and is doubled for each failure, up to the max delay (seconds)
+DEFAULT_CIRCUIT_BREAKER_THRESHOLD = 3
+DEFAULT_CIRCUIT_BREAKER_BASE_DELAY = 60
+DEFAULT_CIRCUIT_BREAKER_MAX_DELAY = 6 * 60 * 60
+# How many fetches are kept in the metrics history of each RSS Feed
+DEFAULT_METRICS_HISTORY_SIZE = 100
+# How many torrent files of one RSS Feed update are downloaded at the same time, in total and for each site
+DEFAULT_TORRENT_DOWNLOAD_WORKERS = 4
+DEFAULT_MAX_TORRENT_DOWNLOADS_PER_HOST = 2
+# Random delay (in percent of the update interval) added to each scheduled update
+DEFAULT_UPDATE_JITTER_PERCENT = 5
+# Updates of RSS Feeds with update_on_startup are spread over this many seconds
+DEFAULT_STARTUP_UPDATE_WINDOW = 120
+# Bounds (in minutes) of the update interval of RSS Feeds with adaptive_interval enabled
+DEFAULT_ADAPTIVE_MIN_INTERVAL = 5
+DEFAULT_ADAPTIVE_MAX_INTERVAL = 360
+# Downloads of RSS Feeds larger than this many bytes are aborted
+DEFAULT_MAX_FEED_SIZE = 20 * 1024 * 1024
+# Seconds to wait for the connection to a site, and for data from the site. Fetching the RSS Feed,
+# and downloading the torrent files of an update, must each be done within the update deadline.
+# RSS Feeds with a value of 0 use these defaults.
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 30
+DEFAULT_UPDATE_DEADLINE = 120
+# The HTTP client downloading the RSS Feeds and torrent files. "threads" downloads with requests
+# in threads, "twisted" with Twisted's non-blocking HTTP client in the reactor thread.
+HTTP_ENGINES = ("threads", "twisted")
+DEFAULT_HTTP_ENGINE = "threads"
 
 DUMMY_RSSFEED_KEY = "9999"
 CONFIG_FILENAME = "yarss2.conf"
@@ -36,7 +79,29 @@ __DEFAULT_PREFS = {
     "subscriptions": {},
     "cookies": {},
     "email_messages": {},
-    "general": {"show_log_in_gui": True},
+    "general": {"show_log_in_gui": True,
+                "max_concurrent_fetches": DEFAULT_MAX_CONCURRENT_FETCHES,
+                "max_concurrent_fetches_per_host": DEFAULT_MAX_CONCURRENT_FETCHES_PER_HOST,
+                "max_concurrent_downloads": DEFAULT_MAX_CONCURRENT_DOWNLOADS,
+                "max_queued_downloads": DEFAULT_MAX_QUEUED_DOWNLOADS,
+                "max_queued_updates": DEFAULT_MAX_QUEUED_UPDATES,
+                "overload_policy": DEFAULT_OVERLOAD_POLICY,
+                "overload_delay": DEFAULT_OVERLOAD_DELAY,
+                "metrics_history_size": DEFAULT_METRICS_HISTORY_SIZE,
+                "circuit_breaker_threshold": DEFAULT_CIRCUIT_BREAKER_THRESHOLD,
+                "circuit_breaker_base_delay": DEFAULT_CIRCUIT_BREAKER_BASE_DELAY,
+                "circuit_breaker_max_delay": DEFAULT_CIRCUIT_BREAKER_MAX_DELAY,
+                "torrent_download_workers": DEFAULT_TORRENT_DOWNLOAD_WORKERS,
+                "max_torrent_downloads_per_host": DEFAULT_MAX_TORRENT_DOWNLOADS_PER_HOST,
+                "update_jitter_percent": DEFAULT_UPDATE_JITTER_PERCENT,
+                "startup_update_window": DEFAULT_STARTUP_UPDATE_WINDOW,
+                "adaptive_min_interval": DEFAULT_ADAPTIVE_MIN_INTERVAL,
+                "adaptive_max_interval": DEFAULT_ADAPTIVE_MAX_INTERVAL,
+                "max_feed_size": DEFAULT_MAX_FEED_SIZE,
+                "connect_timeout": DEFAULT_CONNECT_TIMEOUT,
+                "read_timeout": DEFAULT_READ_TIMEOUT,
+                "update_deadline": DEFAULT_UPDATE_DEADLINE,
+                "http_engine": DEFAULT_HTTP_ENGINE},
 }
 
 
@@ -54,6 +119,18 @@ def get_user_agent(rssfeed_data=None):
         return get_default_user_agent()
 
 
+def get_rssfeed_timeouts(rssfeed_data=None, general_config=None):
+    """Returns the (connect timeout, read timeout) and the update deadline (in seconds)
+    of the RSS Feed, using the general config for the values that are 0 in the feed"""
+    general_config = general_config or {}
+    values = []
+    for key, default in (("connect_timeout", DEFAULT_CONNECT_TIMEOUT), ("read_timeout", DEFAULT_READ_TIMEOUT),
+                         ("update_deadline", DEFAULT_UPDATE_DEADLINE)):
+        value = rssfeed_data.get(key, 0) if rssfeed_data else 0
+        values.append(value if value else general_config.get(key, default))
+    return (values[0], values[1]), values[2]
+
+
 def default_prefs():
     return copy.deepcopy(__DEFAULT_PREFS)
 
@@ -202,6 +279,10 @@ class YARSSConfig(object):
         if self._verify_types(None, self.config["email_configurations"], default_config):
             changed = True
 
+        default_config = default_prefs()["general"]
+        if self._insert_missing_dict_values(self.config["general"], default_config, level=1):
+            changed = True
+
         if changed:
             self.config.save()
 
@@ -514,7 +595,8 @@ def get_fresh_email_config():
 
 def get_fresh_rssfeed_config(name=u"", url=u"", site=u"", active=True, last_update=u"",
                              update_interval=DEFAULT_UPDATE_INTERVAL, update_on_startup=False,
-                             obey_ttl=False, user_agent=u"", key=None):
+                             obey_ttl=False, user_agent=u"", adaptive_interval=False, connect_timeout=0,
+                             read_timeout=0, update_deadline=0, key=None):
     """Create a new config (dictionary) for a feed"""
     config_dict = {}
     config_dict["name"] = name
@@ -527,6 +609,11 @@ def get_fresh_rssfeed_config(name=u"", url=u"", site=u"", active=True, last_upda
     config_dict["obey_ttl"] = obey_ttl
     config_dict["user_agent"] = user_agent
     config_dict["prefer_magnet"] = False
+    config_dict["adaptive_interval"] = adaptive_interval
+    # 0 uses the value in the general config
+    config_dict["connect_timeout"] = connect_timeout
+    config_dict["read_timeout"] = read_timeout
+    config_dict["update_deadline"] = update_deadline
     if key:
         config_dict["key"] = key
     return config_dict